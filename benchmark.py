@@ -0,0 +1,686 @@
+#!/usr/bin/env python
+"""Benchmarks for performance-sensitive parts of the package.
+
+Run as "python benchmark.py BENCHMARK [options]"; see --help for the list
+of benchmarks. Most benchmarks require a database built with
+"python imdb --rebuild-db".
+"""
+
+from argparse import ArgumentParser
+from cStringIO import StringIO
+from functools import partial
+from time import time
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+from zipfile import ZipFile
+
+from imdb import (IMDb, IMDbTitle, chunkedfile, columnstore, parsers, search,
+                  similarity, utils)
+from imdb.chunkedfile import CHUNK_CACHE, ChunkedFile
+from imdb.utils import Timer
+
+def _read_queries(filename):
+    """Read (query, year) pairs from a file in the format of TESTS."""
+    queries = []
+    with open(filename) as fh:
+        for line in fh:
+            line = line.decode('utf-8').strip()
+            if not line or line[0] == '#':
+                continue
+            title, year = line.split('|')[0:2]
+            queries.append((title, int(year) if year else None))
+    return queries
+
+def _timed(func, *args, **kwargs):
+    """Call func, returning its result and the elapsed time."""
+    start = time()
+    ret = func(*args, **kwargs)
+    return ret, time() - start
+
+def bench_similarity(args):
+    """Compare string similarity backends used to rank search results."""
+    queries = _read_queries(args.queries)
+    # Gather the search candidates of each query once, so that only the
+    # similarity computation is measured.
+    timer = Timer()
+    candidates = [[] for _ in queries]
+    for matches, entry in search._search_index(
+            timer, args.dbfile, [(query.split(), year)
+                                 for query, year in queries], 5):
+        for qidx in matches:
+            candidates[qidx].append(entry)
+    ncandidates = sum(len(entries) for entries in candidates)
+    print '%d queries, %d candidates' % (len(queries), ncandidates)
+
+    results = {}
+    print '%-10s %12s %12s %12s' % ('backend', 'ratios/s', 'rank (s)',
+                                    'top-1 agree')
+    for name in sorted(similarity.BACKENDS):
+        backend = similarity.BACKENDS[name]
+        # Raw similarity throughput, one query against many titles
+        elapsed = 0
+        for (query, _), entries in zip(queries, candidates):
+            titles = [entry[4] for entry in entries]  # Lower-cased title
+            _, duration = _timed(backend(query.lower()).ratios, titles)
+            elapsed += duration
+        # Complete ranking, including pruning and weighting
+        top = []
+        start = time()
+        for (query, year), entries in zip(queries, candidates):
+            scorer = search._Scorer(query, year, backend=backend)
+            for entry in entries:
+                scorer.add(*entry)
+            top.append(max(scorer.scores, key=scorer.scores.get)
+                       if scorer.scores else None)
+        ranktime = time() - start
+        results[name] = top
+        agree = sum(1 for i, j in zip(top, results['difflib']) if i == j) \
+            if 'difflib' in results else len(top)
+        print '%-10s %12.0f %12.4f %8d/%-3d' % (name, ncandidates/elapsed,
+                                                ranktime, agree, len(top))
+
+def bench_record(args):
+    """Populate every property of the top search result of each query, one
+    title at a time (as for separate requests to wsgi.py): one property
+    after another, and with IMDb.populate, which reads the data files of
+    all properties at the same time."""
+    queries = _read_queries(args.queries)
+    iface = IMDb(dbfile=args.dbfile)
+    titles = []
+    for query, year in queries:
+        results = iface.search(query, year=year)
+        if results:
+            titles.append(results[0][0].title)
+    populators = [getattr(iface, name) for name in sorted(dir(iface))
+                  if name.startswith('populate_')]
+
+    def populate_each():
+        """Populate each property of each title separately."""
+        for title in titles:
+            for populator in populators:
+                populator((IMDbTitle(title, backend=iface),))
+
+    def populate_all():
+        """Populate all properties of each title in one call."""
+        for title in titles:
+            iface.populate((IMDbTitle(title, backend=iface),))
+
+    populate_all()                      # Start the pool; fill the cache
+    print '%d titles, %d properties, %d CPUs' % \
+        (len(titles), len(populators), multiprocessing.cpu_count())
+    print '%-12s %10s %12s' % ('method', 'total (s)', 'per title (s)')
+    for name, func in (('sequential', populate_each),
+                       ('populate', populate_all)):
+        _, elapsed = _timed(func)
+        print '%-12s %10.4f %12.4f' % (name, elapsed,
+                                       elapsed/max(len(titles), 1))
+
+def bench_query(args):
+    """Run analytical queries over every title with IMDb.query (twice, the
+    second time with the columns already loaded), and as before, by reading
+    whole data files into dictionaries with the parsers and filtering
+    them."""
+    iface = IMDb(dbfile=args.dbfile)
+    queries = [
+        ('2000 horror, >100 votes, by score',
+         dict(year=2000, votes=(101, None), genre='Horror', sort='-score')),
+        ('top 100 by votes', dict(votes=(0, None), sort='-votes',
+                                  limit=100)),
+        ('score >= 8, 90-120 min', dict(score=(8.0, None),
+                                        running_time=(90, 120))),
+        ('R-rated comedies of 2000', dict(year=2000, genre='Comedy',
+                                          certificate='R')),
+    ]
+
+    def parser_query(year=None, votes=None, score=None, genre=None,
+                     certificate=None, running_time=None, sort=None,
+                     limit=None):
+        """Answer a query by searching data files with the parsers."""
+        def search(parser, needed):
+            """Return all search results of parser, if needed."""
+            if not needed:
+                return {}
+            obj = parser(dbfile=args.dbfile)
+            obj.columnsfile = None
+            return obj.search()
+
+        ratings = search(parsers.IMDbRatingParser, votes or score or sort)
+        genres = search(parsers.IMDbGenresParser, genre)
+        certificates = search(parsers.IMDbCertificatesParser, certificate)
+        times = search(parsers.IMDbRunningTimeParser, running_time)
+        # Every title matching the query has a result from each parser used
+        titles = []
+        for title in (ratings or genres or certificates or times):
+            parsed = IMDbTitle.parse(title)
+            if year and not (parsed.year and int(parsed.year) == year):
+                continue
+            if votes and not (title in ratings and
+                              ratings[title].nratings >= votes[0]):
+                continue
+            if score and not (title in ratings and
+                              float(ratings[title].score) >= score[0]):
+                continue
+            if genre and genre not in genres.get(title, ()):
+                continue
+            if certificate and \
+                    certificates.get(title, (None,))[0] != certificate:
+                continue
+            if running_time and not (times.get(title) and running_time[0] <=
+                                     times[title] <= running_time[1]):
+                continue
+            titles.append(title)
+        # Titles with equal values are in order of title, as from query
+        titles.sort(key=lambda title: title.encode('utf-8'))
+        if sort == '-score':
+            titles.sort(key=lambda title: float(ratings[title].score),
+                        reverse=True)
+        elif sort == '-votes':
+            titles.sort(key=lambda title: ratings[title].nratings,
+                        reverse=True)
+        return titles[:limit]
+
+    print '%-36s %8s %10s %10s %10s' % ('query', 'titles', 'query (s)',
+                                        'again (s)', 'parsers (s)')
+    for name, kwargs in queries:
+        CHUNK_CACHE.clear()
+        results, cold = _timed(iface.query, **kwargs)
+        _, warm = _timed(iface.query, **kwargs)
+        expected, elapsed = _timed(parser_query, **kwargs)
+        assert sorted(title.title for title in results) == sorted(expected)
+        print '%-36s %8d %10.4f %10.4f %10.4f' % (name, len(results), cold,
+                                                  warm, elapsed)
+
+def bench_rebuild(args):
+    """Time converting the names data files (cast, directors and writers)
+    in --dbdir, with chunks compressed as they are written and by pools of
+    threads."""
+    if not args.dbdir:
+        print 'The rebuild benchmark requires --dbdir'
+        return
+    threadcounts = (0, 2, 4)
+    print '%-12s' % 'parser' + ''.join('%14s' % ('%d threads (s)' % threads)
+                                       for threads in threadcounts)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for parsername, parser in parsers.parsers():
+            if parsername not in ('Cast', 'Directors', 'Writers'):
+                continue
+            times = []
+            for threads in threadcounts:
+                dbfile = os.path.join(tmpdir, '%s%d.zip' % (parsername,
+                                                            threads))
+                obj = parser(dbfile=dbfile, dbdir=args.dbdir)
+                _, elapsed = _timed(obj.rebuild_index, do_copy=True,
+                                    threads=threads)
+                times.append(elapsed)
+            print '%-12s' % parsername + ''.join('%14.4f' % elapsed
+                                                 for elapsed in times)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_search(args):
+    """Time IMDb.search for each query, and IMDb.search_many for all."""
+    queries = _read_queries(args.queries)
+    iface = IMDb(dbfile=args.dbfile)
+    iface.search(*queries[0])   # Start any worker processes
+    start = time()
+    for query, year in queries:
+        iface.search(query, year=year)
+    elapsed = time() - start
+    print 'search:      %4d queries in %8.4f seconds (%.1f queries/s)' % \
+        (len(queries), elapsed, len(queries)/elapsed)
+    _, elapsed = _timed(iface.search_many, queries)
+    print 'search_many: %4d queries in %8.4f seconds (%.1f queries/s)' % \
+        (len(queries), elapsed, len(queries)/elapsed)
+
+def bench_columns(args):
+    """Compare the time taken to search each parser with columns for batches
+    of random titles by gathering from the column store (by title ID) and
+    by reading the data file."""
+    store = columnstore.get_store(args.dbfile + '.columns')
+    titles = [store.title(i).decode('utf-8') for i in xrange(store.ntitles)]
+    random.seed(0)
+    print '%d titles' % store.ntitles
+    print '%-14s %8s %12s %12s' % ('parser', 'batch', 'columns (s)',
+                                   'file (s)')
+    for parsername, parser in parsers.parsers():
+        if not parser.columns:
+            continue
+        for size in (1, 100, 10000, len(titles)):
+            batch = random.sample(titles, min(size, len(titles)))
+            obj = parser(dbfile=args.dbfile)
+            results, columns = _timed(obj.search, batch)
+            obj.columnsfile = None
+            CHUNK_CACHE.clear()
+            expected, datafile = _timed(obj.search, batch)
+            assert dict(results) == dict(expected)
+            print '%-14s %8d %12.4f %12.4f' % (parsername, len(batch),
+                                               columns, datafile)
+
+def bench_filmography(args):
+    """Find the credits of random people in each names data file, one at a
+    time and in a batch of 100, with the name index and by reading the
+    whole file."""
+    random.seed(0)
+    print '%-12s %8s %8s %12s %12s' % ('parser', 'people', 'batch',
+                                       'index (s)', 'scan (s)')
+    for parsername, parser in parsers.parsers():
+        obj = parser(dbfile=args.dbfile)
+        if not obj.nameindexfile or not os.path.exists(obj.nameindexfile):
+            continue
+        names = set()
+        for line in ChunkedFile(args.dbfile, obj.listname):
+            if line[0] not in '\t\n-':
+                names.add(line.split('\t', 1)[0].decode('iso-8859-1'))
+        names = sorted(names)
+        for size in (1, 100):
+            batch = random.sample(names, min(size, len(names)))
+            CHUNK_CACHE.clear()
+            credits, indexed = _timed(obj.filmography, batch)
+            obj.nameindexfile = None
+            expected, scanned = _timed(obj.filmography, batch)
+            obj.nameindexfile = parser(dbfile=args.dbfile).nameindexfile
+            assert dict(credits) == dict(expected)
+            print '%-12s %8d %8d %12.4f %12.4f' % (parsername, len(names),
+                                                   len(batch), indexed,
+                                                   scanned)
+
+def bench_lookup(args):
+    """Look up the top search result of each query, one title at a time, in
+    each data file without an index, using its sparse index and using only
+    the bookmarks of its chunks, counting the lines parsed."""
+    queries = _read_queries(args.queries)
+    iface = IMDb(dbfile=args.dbfile)
+    titles = []
+    for query, year in queries:
+        results = iface.search(query, year=year)
+        if results:
+            titles.append(results[0][0].title)
+    print '%d titles' % len(titles)
+    print '%-14s %-10s %12s %14s' % ('parser', 'index', 'lookups/s',
+                                     'lines/lookup')
+    for parsername, parser in parsers.parsers():
+        obj = parser(dbfile=args.dbfile)
+        if obj.indexname:
+            continue
+        parse_line = obj._parse_line
+        nlines = [0]
+
+        def counting_parse_line(line, loc):
+            """Count the lines parsed."""
+            nlines[0] += 1
+            return parse_line(line, loc)
+
+        obj._parse_line = counting_parse_line
+        for name, sparsename in (('bookmarks', None),
+                                 ('sparse', obj.sparsename)):
+            obj.sparsename = sparsename
+            nlines[0] = 0
+            start = time()
+            for title in titles:
+                obj.search((title,))
+            elapsed = time() - start
+            print '%-14s %-10s %12.1f %14.1f' % \
+                (parsername, name, len(titles)/elapsed,
+                 float(nlines[0])/len(titles))
+
+def bench_memory(args):
+    """Compare searches that read the search index from disk with searches
+    using the in-memory index, and report the memory it uses."""
+    queries = _read_queries(args.queries)
+    print '%-8s %10s %12s %12s %12s' % ('mode', 'first (s)', 'queries/s',
+                                        'index (KiB)', 'RSS (KiB)')
+    for in_memory in (False, True):
+        iface = IMDb(dbfile=args.dbfile, in_memory=in_memory)
+        before = utils.resident_memory()
+        _, first = _timed(iface.search, *queries[0])
+        growth = utils.resident_memory() - before
+        start = time()
+        for query, year in queries:
+            iface.search(query, year=year)
+        elapsed = time() - start
+        print '%-8s %10.4f %12.1f %12d %12d' % \
+            ('memory' if in_memory else 'disk', first,
+             len(queries)/elapsed, iface.search_index_memory()/1024,
+             growth/1024)
+
+def bench_prefilter(args):
+    """Compare the throughput of the search index prefilter (used without
+    an n-gram index) with that of testing each word against each line."""
+    queries = _read_queries(args.queries)
+    fileobj = utils.open_compressed(args.dbfile + '.idx')
+    data = fileobj.read()
+    fileobj.close()
+    nlines = data.count('\n')
+    wordlists = [tuple(search._subwords(search._clean_words(query.split()),
+                                        5))
+                 for query, _ in queries]
+
+    def per_line(wordlists):
+        """Prefilter used before the block-based implementation."""
+        for line in StringIO(data):
+            matches = []
+            for qidx, wordlist in enumerate(wordlists):
+                for word in wordlist:
+                    if word in line:
+                        matches.append(qidx)
+                        break
+            if matches:
+                yield matches, line
+
+    def block_find(wordlists):
+        """Prefilter used by search._search_index."""
+        return search._scan_index(Timer(), StringIO(data), wordlists)
+
+    print '%d lines, %d queries' % (nlines, len(queries))
+    print '%-12s %16s %16s' % ('prefilter', 'lines/s (each)',
+                               'lines/s (batch)')
+    for name, func in (('per-line', per_line), ('block-find', block_find)):
+        start = time()
+        for wordlist in wordlists:
+            for _ in func([wordlist]):
+                pass
+        each = time() - start
+        start = time()
+        for _ in func(wordlists):
+            pass
+        batch = time() - start
+        print '%-12s %16.0f %16.0f' % (name, nlines*len(queries)/each,
+                                       nlines*len(queries)/batch)
+
+def bench_codecs(args):
+    """Compare the size of each file in the database compressed by each
+    codec with the time taken to decompress a random chunk (as for random
+    access to the file)."""
+    if chunkedfile.is_flatfile(args.dbfile):
+        print 'The database is not a zip file'
+        return
+    zipfh = ZipFile(args.dbfile)
+    subfiles = sorted(set(chunkedfile._chunk_prefix(name)[:-len('/c.')]
+                          for name in zipfh.namelist()))
+    zipfh.close()
+    codecs = ['stored', 'zlib:1', 'zlib', 'zlib:9', 'bz2:1', 'bz2']
+    if chunkedfile.lzma:
+        codecs += ['lzma:0', 'lzma']
+    random.seed(0)
+    print '%-16s %-8s %12s %8s %14s' % ('file', 'codec', 'size (KiB)',
+                                        'ratio', 'ms/chunk')
+    for subfile in subfiles:
+        cfh = ChunkedFile(args.dbfile, subfile)
+        chunks = [cfh._read_chunk(chunk.name) for chunk in cfh.chunks]
+        cfh.close()
+        size = sum(len(data) for data in chunks)
+        sample = [random.randrange(len(chunks)) for _ in xrange(100)]
+        for name in codecs:
+            codec = chunkedfile.get_codec(name)
+            compressed = [codec.compress(data) for data in chunks]
+            start = time()
+            for idx in sample:
+                chunkedfile._decompress(compressed[idx],
+                                        codec.compress_type, subfile)
+            elapsed = time() - start
+            csize = sum(len(data) for data in compressed)
+            print '%-16s %-8s %12.1f %7.1f%% %14.3f' % \
+                (subfile, name, csize/1024.0, 100.0*csize/size,
+                 1000*elapsed/len(sample))
+
+def bench_open(args):
+    """Time opening each file in the database, with and without the chunk
+    manifest."""
+    manifest = chunkedfile._load_manifest(args.dbfile, os.stat(args.dbfile))
+    if not manifest:
+        print 'The database has no chunk manifest'
+        return
+    subfiles = sorted(prefix[:-len('/c.')] for prefix in manifest.subfiles)
+    suffix = chunkedfile.MANIFEST_SUFFIX
+    print '%-16s %12s' % ('directory', 'opens/s')
+    for name, use_manifest in (('zip', False), ('manifest', True)):
+        chunkedfile.MANIFEST_SUFFIX = suffix if use_manifest else '.none'
+        rounds = 20 if use_manifest else 2
+        start = time()
+        for _ in xrange(rounds):
+            for subfile in subfiles:
+                ChunkedFile(args.dbfile, subfile).close()
+        print '%-16s %12.1f' % (name, rounds*len(subfiles)/(time()-start))
+    chunkedfile.MANIFEST_SUFFIX = suffix
+
+def bench_populate(args):
+    """Populate every property of the top search result of each query, one
+    title at a time (as for separate requests), twice, with and without the
+    cache of decompressed chunks."""
+    queries = _read_queries(args.queries)
+    iface = IMDb(dbfile=args.dbfile)
+    titles = []
+    for query, year in queries:
+        results = iface.search(query, year=year)
+        if results:
+            titles.append(results[0][0])
+    populators = [getattr(iface, name) for name in sorted(dir(iface))
+                  if name.startswith('populate_')]
+
+    def populate_each():
+        """Populate each property of each title separately."""
+        for title in titles:
+            for populator in populators:
+                populator((title,))
+
+    print '%d titles, %d properties' % (len(titles), len(populators))
+    print '%-8s %10s %10s %8s %8s %10s' % ('cache', 'first (s)', 'again (s)',
+                                          'hits', 'misses', 'evictions')
+    budget = CHUNK_CACHE.budget
+    for name, size in (('none', 0), ('%d MiB' % (budget/1048576), budget)):
+        CHUNK_CACHE.set_budget(size)
+        CHUNK_CACHE.clear()
+        _, first = _timed(populate_each)
+        _, again = _timed(populate_each)
+        stats = CHUNK_CACHE.stats()
+        print '%-8s %10.4f %10.4f %8d %8d %10d' % \
+            (name, first, again, stats['hits'], stats['misses'],
+             stats['evictions'])
+    CHUNK_CACHE.set_budget(budget)
+
+def bench_readahead(args):
+    """Time full scans of each data file, parsing every line (as for
+    IMDbRatingParser.search() with no queries), with and without read-ahead
+    of chunks on a background thread."""
+    budget = CHUNK_CACHE.budget
+    CHUNK_CACHE.set_budget(0)   # Decompress every chunk on every scan
+    readahead = parsers.READAHEAD
+    print '%-16s %14s %14s %8s' % ('parser', 'plain (s)',
+                                   'read-ahead (s)', 'speedup')
+    for parsername, parser in parsers.parsers():
+        obj = parser(dbfile=args.dbfile)
+        times = []
+        for chunks in (0, readahead):
+            parsers.READAHEAD = chunks
+            start = time()
+            for _ in obj._run_search(None):
+                pass
+            times.append(time() - start)
+        print '%-16s %14.4f %14.4f %7.2fx' % (parsername, times[0], times[1],
+                                              times[0]/times[1])
+    parsers.READAHEAD = readahead
+    CHUNK_CACHE.set_budget(budget)
+
+class _LinearChunkedFile(ChunkedFile):
+    """ChunkedFile with the linear chunk lookups it used to have."""
+
+    def seek(self, offset, whence=0):
+        """Seek to offset (whence=0 only)."""
+        self.flush()
+        self.nextbuf = []
+        self.readbuf = ''
+        self.chunkidx = -1
+        self.pos = 0
+        for idx, data in enumerate(self.chunks):
+            if data.pos <= offset:
+                self.chunkidx = idx-1
+                self.pos = data.pos
+        self.read(offset-self.pos)
+
+    def find_bookmark(self, bookmark, give_range=False):
+        """Determine an appropriate seek position near bookmark."""
+        pos = 0
+        for chunk in self.chunks:
+            if chunk.bookmark and chunk.bookmark < bookmark:
+                pos = chunk.pos
+        if give_range:
+            ret_next = 0
+            for chunk in self.chunks:
+                if ret_next == 1:
+                    return pos, chunk.pos
+                elif chunk.bookmark and chunk.bookmark > bookmark:
+                    ret_next = 1
+            return pos, None
+        else:
+            return pos
+
+def bench_chunkedfile(args):
+    """Time ChunkedFile.find_bookmark and seek on a file with many chunks,
+    compared with linear lookups, and reading lines from the file. Does not
+    use the database."""
+    nrecords = 200000
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'chunks.zip')
+        cfh = ChunkedFile(filename, 'test', mode='w', chunksize=512)
+        for i in xrange(nrecords):
+            cfh.bookmark('title %08d' % i)
+            cfh.write('title %08d\tsome data about this title\n' % i)
+        cfh.close()
+
+        random.seed(0)
+        bookmarks = ['title %08d' % random.randrange(nrecords)
+                     for _ in xrange(2000)]
+        results = {}
+        print '%-8s %8s %16s %12s' % ('lookup', 'chunks', 'find_bookmark/s',
+                                      'seek/s')
+        for name, cls in (('linear', _LinearChunkedFile),
+                          ('bisect', ChunkedFile)):
+            cfh = cls(filename, 'test')
+            ranges, elapsed = _timed(lambda: [cfh.find_bookmark(bookmark,
+                                                                True)
+                                              for bookmark in bookmarks])
+            results[name] = ranges
+            start = time()
+            for pos, _ in ranges:
+                cfh.seek(pos)
+            seektime = time() - start
+            print '%-8s %8d %16.0f %12.0f' % (name, len(cfh.chunks),
+                                              len(bookmarks)/elapsed,
+                                              len(ranges)/seektime)
+            cfh.close()
+        assert results['linear'] == results['bisect']
+
+        def tell_each(cfh):
+            """Iterate over lines, calling tell() for each."""
+            for _ in cfh:
+                cfh.tell()
+
+        def with_offsets(cfh):
+            """Iterate over lines and their positions."""
+            for _ in cfh.iter_lines_with_offsets():
+                pass
+
+        print '%-24s %12s' % ('iteration', 'lines/s')
+        for name, func in (('lines', list),
+                           ('lines and tell()', tell_each),
+                           ('iter_lines_with_offsets', with_offsets)):
+            cfh = ChunkedFile(filename, 'test')
+            _, elapsed = _timed(func, cfh)
+            cfh.close()
+            print '%-24s %12.0f' % (name, nrecords/elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_titleindex(args):
+    """Compare the size of the index of each indexed data file with its
+    binary title index, and the time taken to find the seek positions of a
+    batch of up to 10000 random titles of the index in each, and of 100 of
+    them one at a time."""
+    sizes = {}
+    if not chunkedfile.is_flatfile(args.dbfile):
+        zipfh = ZipFile(args.dbfile)
+        for info in zipfh.infolist():
+            prefix = chunkedfile._chunk_prefix(info.filename)
+            if prefix:
+                subfile = prefix[:-len('/c.')]
+                sizes[subfile] = sizes.get(subfile, 0) + info.compress_size
+        zipfh.close()
+    random.seed(0)
+    print '%-14s %-8s %12s %12s %10s %12s %12s' % \
+        ('parser', 'index', 'size (KiB)', 'disk (KiB)', 'titles',
+         'batch (s)', 'single (ms)')
+    for parsername, parser in parsers.parsers():
+        obj = parser(dbfile=args.dbfile)
+        if not obj.indexname or not os.path.exists(obj.titleindexfile):
+            continue
+        indexfh = ChunkedFile(args.dbfile, obj.indexname)
+        data = indexfh.read()
+        indexfh.close()
+        titles = [line.split('\t', 1)[0].decode('utf-8')
+                  for line in data.splitlines()]
+        titles = set(random.sample(titles, min(len(titles), 10000)))
+        tixsize = os.path.getsize(obj.titleindexfile)
+        results = []
+        for name, size, disk, func, filename in (
+                ('text', len(data), sizes.get(obj.indexname, len(data)),
+                 parsers._find_seeks_index, args.dbfile),
+                ('binary', tixsize, tixsize, parsers._find_seeks_titleindex,
+                 obj.titleindexfile)):
+            if func is parsers._find_seeks_index:
+                func = partial(func, filename, obj.indexname)
+            else:
+                func = partial(func, filename)
+            CHUNK_CACHE.clear()
+            locs, elapsed = _timed(lambda: list(func(titles)))
+            results.append(locs)
+            single = list(titles)[:100]
+            _, single_elapsed = _timed(lambda: [list(func((title,)))
+                                                for title in single])
+            print '%-14s %-8s %12.1f %12.1f %10d %12.4f %12.3f' % \
+                (parsername, name, size/1024.0, disk/1024.0, len(titles),
+                 elapsed, 1000*single_elapsed/len(single))
+        assert results[0] == results[1]
+
+BENCHMARKS = {
+    'chunkedfile': bench_chunkedfile,
+    'codecs': bench_codecs,
+    'columns': bench_columns,
+    'filmography': bench_filmography,
+    'lookup': bench_lookup,
+    'memory': bench_memory,
+    'open': bench_open,
+    'populate': bench_populate,
+    'prefilter': bench_prefilter,
+    'query': bench_query,
+    'readahead': bench_readahead,
+    'record': bench_record,
+    'rebuild': bench_rebuild,
+    'search': bench_search,
+    'similarity': bench_similarity,
+    'titleindex': bench_titleindex,
+}
+
+def _main(argv):
+    """Command-line interface."""
+    parser = ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS),
+                        help='Benchmark to run')
+    parser.add_argument('--dbfile', default='imdb.zip',
+                        help='Database file')
+    parser.add_argument('--dbdir',
+                        help='Directory of IMDb data files (for rebuild)')
+    parser.add_argument('--queries', default='TESTS',
+                        help='Search queries, in the format of TESTS')
+    args = parser.parse_args(argv)
+    # Measure processing time, not the time spent sleeping to rate-limit
+    utils.RATELIMIT = (utils.RATELIMIT[0], 0)
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == '__main__':
+    _main(sys.argv[1:])
@@ -9,10 +9,14 @@ ftp://ftp.sunet.se/pub/tv+movies/imdb/
 import heapq
 import re
 import os
+from multiprocessing import cpu_count
 
+import chunkedfile
 from chunkedfile import ChunkedFile
-from utils import Timer
+import columnstore
+from utils import Timer, get_pool, wait_result
 import parsers
+import query
 import search
 
 # Notes on handling plot summaries:
@@ -30,7 +34,8 @@ class IMDbTitle(object):
     If a backend IMDb object is provided, undefined attributes (e.g. rating)
     will be populated from the backend on-demand. Note that if populating
     multiple IMDbTitles is desired, it will be much faster to use
-    IMDb.populate_rating or equivalent."""
+    IMDb.populate_rating or equivalent (or IMDb.populate, for several
+    properties at once)."""
 
     def __init__(self, title, backend=None):
         self.title = title
@@ -50,38 +55,212 @@ class IMDbTitle(object):
 
     parse = staticmethod(parsers.parse_title)
 
+class IMDbQueryResults(object):
+    """The titles found by IMDb.query, as a sequence of IMDbTitle objects
+    created as they are used."""
+
+    def __init__(self, backend, store, titleids):
+        self.backend = backend
+        self.store = store
+        self.titleids = titleids
+
+    def __repr__(self):
+        return 'IMDbQueryResults(%d titles)' % len(self.titleids)
+
+    def __len__(self):
+        return len(self.titleids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return IMDbQueryResults(self.backend, self.store,
+                                    self.titleids[index])
+        return IMDbTitle(self.store.title(self.titleids[index])
+                         .decode('utf-8'), backend=self.backend)
+
+    def __iter__(self):
+        for i in xrange(len(self.titleids)):
+            yield self[i]
+
 class IMDb(object):
     """Main interface to IMDb."""
 
-    def __init__(self, dbfile, debug=False):
+    def __init__(self, dbfile, debug=False, similarity=None,
+                 in_memory=False):
+        """Open the database dbfile. similarity selects the string
+        similarity measure used to rank search results: 'difflib' (the
+        default) or 'lcs' (see similarity.BACKENDS). If in_memory=True,
+        the search index is loaded into memory by the first search and
+        kept for later searches, which is faster for long-running processes
+        (see search_index_memory)."""
         self.dbfile = dbfile
         self.debug = debug
+        self.similarity = similarity
+        self.in_memory = in_memory
 
-    def rebuild_index(self, dbdir):
+    def rebuild_index(self, dbdir, shards=1, container='zip', codecs=None,
+                      threads=0):
         """Convert and index data files for random access.
-           Index movie list for searching."""
+           Index movie list for searching. To search using multiple
+           processes, split the search index into several shards.
+           container selects how the data files are stored: 'zip'
+           (compressed) or 'flat' (uncompressed and memory-mapped, see
+           chunkedfile.FlatFile). codecs optionally maps the names of the
+           data files in a zip container (such as 'plot' or 'cast.index')
+           to the codec used to compress each, with the key '*' for the
+           others (see chunkedfile.get_codec; by default, zlib). threads
+           is the number of threads compressing the data files in parallel
+           (by default, data is compressed as it is converted)."""
         # Import and index data files
         if os.path.exists(self.dbfile):
             raise Exception('%s exists' % self.dbfile)
+        codecs = codecs or {}
+        if container == 'flat':
+            if codecs:
+                raise ValueError('The flat container is not compressed')
+            # ChunkedFile stores data in the container it finds
+            chunkedfile.FlatFile(self.dbfile, 'w').close()
+        elif container != 'zip':
+            raise ValueError('Unknown container %s' % container)
+        for codec in codecs.values():
+            chunkedfile.get_codec(codec)    # Check before creating files
         for parsername, parser in parsers.parsers():
             obj = parser(dbfile=self.dbfile, dbdir=dbdir, debug=self.debug)
             if self.debug:
                 print "Indexing %s..." % parsername
             with Timer(indent=2, quiet=not self.debug):
-                obj.rebuild_index(do_copy=True)
+                obj.rebuild_index(do_copy=True, codecs=dict(
+                    (name, codecs.get(name, codecs.get('*')))
+                    for name in (obj.listname, obj.indexname,
+                                 obj.sparsename) if name),
+                                  threads=threads)
+        # Allow the data files to be opened without reading the whole zip
+        # file directory
+        if container == 'zip':
+            chunkedfile.write_manifest(self.dbfile)
 
         # Create index of movie titles
         if self.debug:
             print "Creating search index..."
         with Timer(indent=2, quiet=not self.debug):
-            search.create_index(self.dbfile, dbdir, debug=self.debug)
+            search.create_index(self.dbfile, dbdir, shards=shards,
+                                debug=self.debug)
+
+        # Store scalar properties in columns, by title ID
+        if self.debug:
+            print "Creating title columns..."
+        with Timer(indent=2, quiet=not self.debug):
+            parsers.create_columns(self.dbfile, dbdir, debug=self.debug)
 
     def search(self, query, year=None, timeout=None):
         """Search the database for query, optionally with an estimated year."""
         scores, akascores = search.search(self.dbfile, query, year,
-                                          debug=self.debug, timeout=timeout)
+                                          debug=self.debug, timeout=timeout,
+                                          backend=self.similarity,
+                                          in_memory=self.in_memory)
+        return self._search_results(scores, akascores)
+
+    def search_many(self, queries, timeout=None):
+        """Search the database for each of queries, a list of (query, year)
+        pairs (year may be None). This is much faster than calling search
+        for each query, since the search index is only read once. Returns
+        a list containing the results of each query, as from search."""
+        return [self._search_results(scores, akascores)
+                for scores, akascores in
+                search.search_many(self.dbfile, queries, debug=self.debug,
+                                   timeout=timeout,
+                                   backend=self.similarity,
+                                   in_memory=self.in_memory)]
+
+    def populate(self, titles, fields=None, timeout=10*60):
+        """Populate several properties (fields, a list of property names
+        such as 'rating' or 'cast'; by default, all of them) of multiple
+        IMDbTitle objects in one call. Each property is only read for the
+        titles on which it is not already set. The data files are read at
+        the same time by a pool of worker processes (one per CPU, see
+        _populate_field), so this takes about as long as populating the
+        slowest property, rather than all of them in turn. Raises
+        TimerTimeout if the workers take longer than timeout seconds."""
+        titles = tuple(title for title in titles)
+        if fields is None:
+            fields = sorted(PROPERTIES)
+        for name in fields:
+            if name not in PROPERTIES:
+                raise ValueError('Unknown property %s' % name)
+        missing = []
+        for name in fields:
+            pending = [title for title in titles
+                       if not hasattr(title, '_'+name)]
+            if pending:
+                missing.append((name, pending))
+        tasks = [(name, self.dbfile, self.debug,
+                  [title.title for title in pending])
+                 for name, pending in missing]
+        if len(tasks) > 1 and cpu_count() > 1:
+            results = wait_result(get_pool().map_async(_populate_field,
+                                                       tasks),
+                                  Timer(timeout=timeout))
+        else:
+            results = [_populate_field(task) for task in tasks]
+        for (name, pending), result in zip(missing, results):
+            default = PROPERTIES[name].default
+            for title in pending:
+                setattr(title, name, result.get(title.title, default))
+
+    def query(self, year=None, votes=None, score=None, genre=None,
+              certificate=None, running_time=None, sort=None, limit=None):
+        """Return the titles matching every filter that is given, as an
+        IMDbQueryResults sequence of IMDbTitles. year, votes (the number of
+        ratings), score and running_time are ranges of values, as a pair
+        (min, max) (inclusive; either may be None) or a single value. genre
+        is a genre or a list of genres, all of which the titles must have;
+        certificate is a certificate or a list of certificates, any of which
+        the titles may have. Titles are returned in order of title, or
+        sorted by sort, the name of a filter or 'title', prefixed with '-'
+        for descending order (titles without a value come last), and at
+        most limit titles are returned. For example, the best-rated horror
+        films of the 1990s with more than 10000 votes are
+        query(year=(1990, 1999), votes=(10001, None), genre='Horror',
+        sort='-score', limit=10).
+        Queries read the columns of the database (see
+        parsers.create_columns), not the data files."""
+        store = columnstore.get_store(self.dbfile + '.columns')
+        titleids = query.query(store, {'year': year, 'votes': votes,
+                                       'score': score, 'genre': genre,
+                                       'certificate': certificate,
+                                       'running_time': running_time},
+                               sort=sort, limit=limit)
+        return IMDbQueryResults(self, store, titleids)
 
-        # Return the top-scoring results
+    def filmography(self, names, roles=None):
+        """Return the credits of each of names (people, named as in the
+        data files, e.g. 'Willis, Bruce'), as a dictionary of dictionaries
+        of lists of (IMDbTitle, character, order, notes), by name and by
+        role. roles is a list of the roles to find: the names of the
+        properties listing people ('cast', 'directors' or 'writers'; by
+        default, all of them)."""
+        names = set(names)
+        if roles is None:
+            roles = sorted(name for name, parser in PROPERTIES.iteritems()
+                           if hasattr(parser, 'filmography'))
+        results = dict((name, {}) for name in names)
+        for role in roles:
+            parserclass = PROPERTIES.get(role)
+            if not hasattr(parserclass, 'filmography'):
+                raise ValueError('Unknown role %s' % role)
+            parser = parserclass(dbfile=self.dbfile, debug=self.debug)
+            for name, credits in parser.filmography(names).iteritems():
+                results[name][role] = [
+                    (IMDbTitle(credit[0], backend=self),) + credit[1:]
+                    for credit in credits]
+        return results
+
+    def search_index_memory(self):
+        """Return the number of bytes of memory used by this process to
+        hold the search index (see in_memory)."""
+        return search.resident_size(self.dbfile)
+
+    def _search_results(self, scores, akascores):
+        """Return the top-scoring results from search.search."""
         numret = 30
         topscores = heapq.nlargest(numret, scores, scores.get)
         titles = dict((title, IMDbTitle(title, backend=self)) \
@@ -130,11 +309,24 @@ def imdb_populator(parserclass, prop, default):
                 setattr(title, prop, default)
     return populate
 
+# Parser class of each IMDbTitle property, by property name
+PROPERTIES = {}
+
+def _populate_field(task):
+    """Return the data of one property for a list of titles, by title, as
+    from the parser's search. Run by the worker processes of IMDb.populate:
+    only the task, a tuple (property name, dbfile, debug, titles), and the
+    results are passed between processes."""
+    name, dbfile, debug, titles = task
+    parser = PROPERTIES[name](dbfile=dbfile, debug=debug)
+    return dict(parser.search(titles))
+
 def _install_parsers():
     """Install support for each parser into the IMDb and IMDbTitle classes."""
     property_name = re.compile(r'(?<=[a-z])([A-Z])')
     for name, parser in parsers.parsers():
         name = property_name.sub(r'_\1', name).lower()
+        PROPERTIES[name] = parser
         populator = imdb_populator(parser, name, default=parser.default)
         setattr(IMDb, 'populate_'+name, populator)
         prop = property(*imdbtitle_property(name),
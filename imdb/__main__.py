@@ -18,6 +18,23 @@ def _main(argv):
                         help='Database file')
     parser.add_argument('--rebuild-db', nargs=1, metavar='DIR',
                         help='Rebuild the database file from IMDb data files')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Number of search index shards to create with '
+                        '--rebuild-db (searched in parallel)')
+    parser.add_argument('--container', choices=('zip', 'flat'),
+                        default='zip',
+                        help='Store the database compressed (zip) or '
+                        'uncompressed and memory-mapped (flat) with '
+                        '--rebuild-db')
+    parser.add_argument('--codec', action='append', default=[],
+                        metavar='[FILE=]CODEC',
+                        help='Compress FILE (such as plot or cast.index; '
+                        'default all files) in the zip container with '
+                        'CODEC (stored, zlib, bz2 or lzma, optionally with '
+                        'a level, such as zlib:1) with --rebuild-db')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='Number of threads compressing the data files '
+                        'in parallel with --rebuild-db')
     parser.add_argument('--search', nargs='*',
                         help='Search the database')
     for argname in SUPPORTED_ARGS:
@@ -35,7 +52,11 @@ def _main(argv):
                  debug=not args.quiet)
 
     if args.rebuild_db:
-        iface.rebuild_index(args.rebuild_db[0])
+        codecs = dict(codec.split('=', 1) if '=' in codec else ('*', codec)
+                      for codec in args.codec)
+        iface.rebuild_index(args.rebuild_db[0], shards=args.shards,
+                            container=args.container, codecs=codecs,
+                            threads=args.threads)
 
     titles = []
     if args.search:
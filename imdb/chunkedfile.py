@@ -1,14 +1,35 @@
 """chunkedfile - Chunked storage of compressed data"""
 
-from collections import namedtuple
-from zipfile import ZipFile, BadZipfile, ZIP_DEFLATED
-from gzip import GzipFile
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple, OrderedDict
+from functools import partial
+from zipfile import ZipFile, ZipInfo, BadZipfile, ZIP_DEFLATED, ZIP_STORED
 from base64 import urlsafe_b64encode, urlsafe_b64decode
+from mmap import mmap, ACCESS_READ
+from multiprocessing.pool import ThreadPool
+from threading import Event, Lock, Thread
+from Queue import Queue, Full
+from gzipindex import IndexedGzipFile
+import bz2
 import os
+import struct
+import sys
+import time
+import zlib
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None     # lzma codec not available
+if lzma is not None and not all(hasattr(lzma, name) for name in
+                                ('FORMAT_RAW', 'FILTER_LZMA1')):
+    lzma = None         # No raw LZMA1 streams, as stored in zip files
 
 class UnpackedZipInfo(object):
     def __init__(self, file_size):
-        self.file_size = size
+        self.file_size = file_size
 
 class UnpackedZipFile(object):
     """Wrapper class for a directory that implements the ZipFile interface"""
@@ -43,40 +64,595 @@ class UnpackedZipFile(object):
         with open(self._path(filename), 'r') as fh:
             return fh.read()
 
+class ChunkCache(object):
+    """Cache of decompressed chunks, shared by the ChunkedFiles of a process
+    (see CHUNK_CACHE). Holds up to budget bytes of chunk data, evicting the
+    least recently used chunks. Safe to use from multiple threads."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._chunks = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, load, store=True):
+        """Return the cached data for key, or call load() to get it and add
+        it to the cache (unless store is false)."""
+        with self._lock:
+            data = self._chunks.pop(key, None)
+            if data is not None:
+                self._chunks[key] = data    # Now most recently used
+                self.hits += 1
+                return data
+            self.misses += 1
+        data = load()
+        if not store:
+            return data
+        with self._lock:
+            if key not in self._chunks and len(data) <= self.budget:
+                self._chunks[key] = data
+                self.size += len(data)
+                self._evict()
+        return data
+
+    def _evict(self):
+        """Remove least recently used chunks until within budget."""
+        while self.size > self.budget:
+            _, data = self._chunks.popitem(last=False)
+            self.size -= len(data)
+            self.evictions += 1
+
+    def set_budget(self, budget):
+        """Change the maximum size of the cache, in bytes (0 to disable)."""
+        with self._lock:
+            self.budget = budget
+            self._evict()
+
+    def clear(self):
+        """Remove all chunks from the cache and reset the counters."""
+        with self._lock:
+            self._chunks.clear()
+            self.size = self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return a dictionary of the cache's counters and size."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': self.size,
+                    'chunks': len(self._chunks), 'budget': self.budget}
+
+# Decompressed chunks, keyed by database file (and its modification time and
+# size, in case it is replaced) and chunk name
+CHUNK_CACHE = ChunkCache(budget=32*1024*1024)
+
 ChunkInfo = namedtuple('ChunkInfo', ('name', 'pos', 'bookmark'))
 
+def _chunk_prefix(name):
+    """Return the prefix of the name of a chunk (see ChunkedFile.prefix),
+    or None if name is not the name of a chunk."""
+    idx = name.rfind('/c.')
+    if idx >= 0:
+        return name[:idx+3]
+    elif name.startswith('c.'):
+        return 'c.'
+    return None
+
+def _chunk_info(name, prefix):
+    """Return the ChunkInfo for the chunk name, which starts with prefix."""
+    nameinfo = name[len(prefix):].split(',')
+    pos = int(nameinfo[0], 16)
+    bookmark = None
+    if len(nameinfo) > 1:
+        bookmark = urlsafe_b64decode(nameinfo[1])
+    return ChunkInfo(name=name, pos=pos, bookmark=bookmark)
+
+def _chunk_index(chunks):
+    """Return the sorted lists used by ChunkedFile.seek and find_bookmark
+    to search chunks: the position of each chunk, and the bookmarks (which
+    are in the same order as positions) and indices of the chunks that have
+    one."""
+    positions = []
+    bookmarks = []
+    bookmarked = []
+    for idx, chunk in enumerate(chunks):
+        positions.append(chunk.pos)
+        if chunk.bookmark:
+            bookmarks.append(chunk.bookmark)
+            bookmarked.append(idx)
+    return positions, bookmarks, bookmarked
+
+def _subfile_index(chunks):
+    """Group chunks (ChunkInfos of any number of ChunkedFiles) by prefix,
+    returning a dictionary mapping each prefix to a tuple of the sorted
+    ChunkInfos and the lists from _chunk_index."""
+    byprefix = {}
+    for chunk in chunks:
+        byprefix.setdefault(_chunk_prefix(chunk.name), []).append(chunk)
+    subfiles = {}
+    for prefix, subfile_chunks in byprefix.iteritems():
+        subfile_chunks.sort(key=lambda chunk: chunk.pos)
+        subfiles[prefix] = (subfile_chunks,) + _chunk_index(subfile_chunks)
+    return subfiles
+
+# Compression codecs for the chunks of a ChunkedFile in a zip file. Each
+# is recorded as the standard zip compression method of the chunks, so any
+# reader (including other zip tools) picks the right decoder.
+ZIP_BZIP2 = 12
+ZIP_LZMA = 14
+
+Codec = namedtuple('Codec', ('name', 'compress_type', 'compress'))
+
+# Names of the codecs, and the range and default of their compression levels
+CODECS = OrderedDict((('stored', None), ('zlib', (0, 9, 6)),
+                      ('bz2', (1, 9, 9))))
+if lzma is not None:
+    CODECS['lzma'] = (0, 9, 6)
+
+# Options of the LZMA1 streams written: the literal context, literal
+# position and position bits, and the dictionary size of each preset (as in
+# liblzma)
+_LZMA_LC, _LZMA_LP, _LZMA_PB = 3, 0, 2
+_LZMA_DICT_SIZES = (1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22, 1 << 23,
+                    1 << 23, 1 << 24, 1 << 25, 1 << 26)
+
+# Whether ZipFile's internals are those that _writestr_compressed uses to
+# add members that are already compressed
+_RAW_ZIP_WRITES = sys.version_info[:2] == (2, 7) and \
+    hasattr(ZipFile, '_writecheck') and hasattr(ZipInfo, 'FileHeader')
+
+def _deflate(data, level):
+    """Compress data as a raw deflate stream (as stored in zip files)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+def _lzma_compress(data, preset):
+    """Compress data in the format of LZMA-compressed zip members: a header
+    with the LZMA SDK version and the properties of the raw LZMA1 stream
+    that follows."""
+    dict_size = _LZMA_DICT_SIZES[preset]
+    lzma1 = {'id': lzma.FILTER_LZMA1, 'preset': preset,
+             'dict_size': dict_size, 'lc': _LZMA_LC, 'lp': _LZMA_LP,
+             'pb': _LZMA_PB}
+    props = struct.pack('<BI', (_LZMA_PB*5 + _LZMA_LP)*9 + _LZMA_LC,
+                        dict_size)
+    return struct.pack('<BBH', 9, 4, len(props)) + props + \
+        lzma.compress(data, format=lzma.FORMAT_RAW, filters=[lzma1])
+
+def _lzma_decompress(data):
+    """Decompress an LZMA-compressed zip member (see _lzma_compress)."""
+    propslen, = struct.unpack_from('<H', data, 2)
+    bits, dict_size = struct.unpack_from('<BI', data, 4)
+    lzma1 = {'id': lzma.FILTER_LZMA1, 'dict_size': dict_size,
+             'lc': bits % 9, 'lp': bits // 9 % 5, 'pb': bits // 45}
+    return lzma.decompress(data[4+propslen:], format=lzma.FORMAT_RAW,
+                           filters=[lzma1])
+
+def get_codec(spec):
+    """Return the Codec named by spec: the name of a codec (one of CODECS:
+    stored, zlib, bz2 or lzma), optionally followed by a colon and a
+    compression level, such as zlib:1 or bz2:9. lzma requires the lzma
+    module (Python 3, or backports.lzma)."""
+    name, _, level = spec.partition(':')
+    if name == 'lzma' and lzma is None:
+        raise ValueError('Codec %s requires the lzma module' % spec)
+    if name not in CODECS:
+        raise ValueError('Unknown codec %s' % spec)
+    levels = CODECS[name]
+    if level:
+        try:
+            level = int(level)
+        except ValueError:
+            level = None
+        if level is None or levels is None or \
+                not levels[0] <= level <= levels[1]:
+            raise ValueError('Invalid compression level in codec %s' % spec)
+    elif levels:
+        level = levels[2]
+    if name == 'stored':
+        return Codec(spec, ZIP_STORED, lambda data: data)
+    elif name == 'zlib':
+        return Codec(spec, ZIP_DEFLATED, partial(_deflate, level=level))
+    elif name == 'bz2':
+        return Codec(spec, ZIP_BZIP2, partial(bz2.compress,
+                                              compresslevel=level))
+    return Codec(spec, ZIP_LZMA, partial(_lzma_compress, preset=level))
+
+def _decompress(data, compress_type, filename):
+    """Return data (the contents of filename in a zip file) decompressed
+    according to compress_type, its zip compression method."""
+    if compress_type == ZIP_STORED:
+        return data
+    elif compress_type == ZIP_DEFLATED:
+        return zlib.decompress(data, -15)
+    elif compress_type == ZIP_BZIP2:
+        return bz2.decompress(data)
+    elif compress_type == ZIP_LZMA and lzma is not None:
+        return _lzma_decompress(data)
+    raise BadZipfile('Unsupported compression method %d for file %s' %
+                     (compress_type, filename))
+
+def _data_offset(fh, info):
+    """Return the offset in the zip file open as fh of the (compressed) data
+    of the member described by the ZipInfo info."""
+    # The data follows the local file header, whose extra field may
+    # differ from that in the central directory
+    fh.seek(info.header_offset + 26)
+    namelen, extralen = struct.unpack('<HH', fh.read(4))
+    return info.header_offset + 30 + namelen + extralen
+
+def _read_compressed(zipfh, filename):
+    """Read and return the contents of filename from the ZipFile zipfh,
+    including members compressed by methods that ZipFile does not
+    support."""
+    info = zipfh.getinfo(filename)
+    zipfh.fp.seek(_data_offset(zipfh.fp, info))
+    data = _decompress(zipfh.fp.read(info.compress_size), info.compress_type,
+                       filename)
+    if zlib.crc32(data) & 0xffffffff != info.CRC:
+        raise BadZipfile('Bad CRC-32 for file %s' % filename)
+    return data
+
+def _raw_zip_writes(zipfh):
+    """Return True if compressed members can be added to the ZipFile zipfh
+    by _writestr_compressed (see _RAW_ZIP_WRITES)."""
+    return _RAW_ZIP_WRITES and all(hasattr(zipfh, attr) for attr in
+                                   ('fp', 'filelist', 'NameToInfo',
+                                    '_didModify'))
+
+def _writestr_compressed(zipfh, filename, data, compress_type, compressed):
+    """Write data to the ZipFile zipfh as filename, given its compressed form
+    and compress_type, the compression method (see Codec). (Like
+    ZipFile.writestr, which only supports zlib at the default level or no
+    compression, and compresses data itself.) If ZipFile is not the version
+    expected, data is written by ZipFile.writestr instead, stored or
+    compressed with zlib at the default level."""
+    zinfo = ZipInfo(filename=filename,
+                    date_time=time.localtime(time.time())[:6])
+    zinfo.external_attr = 0600 << 16
+    if not _raw_zip_writes(zipfh):
+        zinfo.compress_type = ZIP_STORED if compress_type == ZIP_STORED \
+            else ZIP_DEFLATED
+        zipfh.writestr(zinfo, data)
+        return
+    zinfo.compress_type = ZIP_STORED    # Checked by _writecheck
+    zinfo.file_size = len(data)
+    zinfo.header_offset = zipfh.fp.tell()
+    zipfh._writecheck(zinfo)
+    zipfh._didModify = True
+    zinfo.compress_type = compress_type
+    zinfo.compress_size = len(compressed)
+    zinfo.CRC = zlib.crc32(data) & 0xffffffff
+    if compress_type == ZIP_BZIP2:
+        zinfo.create_version = zinfo.extract_version = 46
+    elif compress_type == ZIP_LZMA:
+        zinfo.create_version = zinfo.extract_version = 63
+        zinfo.flag_bits |= 0x02     # The stream has an end marker
+    zipfh.fp.write(zinfo.FileHeader())
+    zipfh.fp.write(compressed)
+    zipfh.fp.flush()
+    zipfh.filelist.append(zinfo)
+    zipfh.NameToInfo[filename] = zinfo
+
+# Chunk manifest, written alongside a zip file (to filename+MANIFEST_SUFFIX)
+# so that ChunkedFiles can be opened without reading the zip file's central
+# directory (see write_manifest). Layout (all integers little-endian):
+#   header  -- _MANIFEST_HEADER (magic, size and mtime of the zip file,
+#              number of chunks)
+#   chunks  -- for each chunk, _MANIFEST_CHUNK (offset of the compressed
+#              data in the zip file, compressed size, size, CRC-32,
+#              compression type, position, name length, bookmark length),
+#              followed by the name and bookmark
+MANIFEST_SUFFIX = '.manifest'
+_MANIFEST_MAGIC = 'IMDBMAN1'
+_MANIFEST_HEADER = struct.Struct('<8sQdI')
+_MANIFEST_CHUNK = struct.Struct('<QIIIHQHH')
+
+ManifestMember = namedtuple('ManifestMember', ('offset', 'compress_size',
+                                               'file_size', 'crc',
+                                               'compress_type'))
+Manifest = namedtuple('Manifest', ('members', 'subfiles'))
+
+def write_manifest(filename):
+    """Write the manifest of the chunks of all ChunkedFiles in the zip file
+    filename. The manifest is ignored if the zip file is later modified."""
+    statobj = os.stat(filename)
+    zipfh = ZipFile(filename, 'r')
+    records = []
+    with open(filename, 'rb') as fh:
+        for info in zipfh.infolist():
+            prefix = _chunk_prefix(info.filename)
+            if prefix is None:
+                continue
+            chunk = _chunk_info(info.filename, prefix)
+            bookmark = chunk.bookmark or ''
+            records.append(_MANIFEST_CHUNK.pack(
+                _data_offset(fh, info), info.compress_size, info.file_size,
+                info.CRC, info.compress_type, chunk.pos, len(chunk.name),
+                len(bookmark)) + chunk.name + bookmark)
+    zipfh.close()
+    with open(filename + MANIFEST_SUFFIX, 'wb') as fh:
+        fh.write(_MANIFEST_HEADER.pack(_MANIFEST_MAGIC, statobj.st_size,
+                                       statobj.st_mtime, len(records)))
+        fh.write(''.join(records))
+
+# Manifests loaded by this process, by filename
+_MANIFESTS = {}
+
+def _load_manifest(filename, statobj):
+    """Return the Manifest of filename (whose os.stat is statobj), or None
+    if it does not have an up-to-date manifest."""
+    manifestfile = os.path.abspath(filename) + MANIFEST_SUFFIX
+    cached = _MANIFESTS.get(manifestfile)
+    if cached and cached[0] == (statobj.st_size, statobj.st_mtime):
+        return cached[1]
+    try:
+        with open(manifestfile, 'rb') as fh:
+            data = fh.read()
+    except IOError:
+        return None
+    if len(data) < _MANIFEST_HEADER.size:
+        return None
+    magic, size, mtime, nchunks = _MANIFEST_HEADER.unpack_from(data, 0)
+    if magic != _MANIFEST_MAGIC or \
+            (size, mtime) != (statobj.st_size, statobj.st_mtime):
+        return None
+
+    members = {}
+    chunks = []
+    offset = _MANIFEST_HEADER.size
+    for _ in xrange(nchunks):
+        (dataoffset, compress_size, file_size, crc, compress_type, pos,
+         namelen, bookmarklen) = _MANIFEST_CHUNK.unpack_from(data, offset)
+        offset += _MANIFEST_CHUNK.size
+        name = data[offset:offset+namelen]
+        offset += namelen
+        bookmark = data[offset:offset+bookmarklen] or None
+        offset += bookmarklen
+        members[name] = ManifestMember(dataoffset, compress_size, file_size,
+                                       crc, compress_type)
+        chunks.append(ChunkInfo(name=name, pos=pos, bookmark=bookmark))
+    manifest = Manifest(members, _subfile_index(chunks))
+    _MANIFESTS[manifestfile] = ((statobj.st_size, statobj.st_mtime),
+                                manifest)
+    return manifest
+
+class ManifestZipFile(object):
+    """Wrapper class for a zip file with a manifest (see write_manifest)
+    that implements the ZipFile interface for reading, without reading the
+    zip file's central directory."""
+
+    def __init__(self, filename, manifest):
+        self.fh = open(filename, 'rb')
+        self.manifest = manifest
+
+    def close(self):
+        """Close the zip file."""
+        self.fh.close()
+
+    def getinfo(self, filename):
+        """Return a ZipInfo-compatible structure with file metadata."""
+        return UnpackedZipInfo(
+            file_size=self.manifest.members[filename].file_size)
+
+    def namelist(self):
+        """Return a list of the names of the chunks in the zip file."""
+        return self.manifest.members.keys()
+
+    def chunk_index(self, prefix):
+        """Return the ChunkInfos of the chunks with prefix, and the lists
+        used to search them (see _subfile_index)."""
+        return self.manifest.subfiles.get(prefix, ([], [], [], []))
+
+    def read(self, filename):
+        """Read and return the contents of a file."""
+        member = self.manifest.members[filename]
+        self.fh.seek(member.offset)
+        data = _decompress(self.fh.read(member.compress_size),
+                           member.compress_type, filename)
+        if zlib.crc32(data) & 0xffffffff != member.crc:
+            raise BadZipfile('Bad CRC-32 for file %s' % filename)
+        return data
+
+# Flat container, storing files uncompressed. Layout (all integers
+# little-endian):
+#   magic   -- _FLAT_MAGIC
+#   data    -- the contents of each file, one after another
+#   table   -- for each file, _FLAT_MEMBER (offset, size, name length),
+#              followed by the name
+#   trailer -- _FLAT_TRAILER (offset of table, number of files, magic)
+_FLAT_MAGIC = 'IMDBFLT1'
+_FLAT_MEMBER = struct.Struct('<QQH')
+_FLAT_TRAILER = struct.Struct('<QI8s')
+
+def is_flatfile(filename):
+    """Return True if filename is a flat container (see FlatFile)."""
+    try:
+        with open(filename, 'rb') as fh:
+            return fh.read(len(_FLAT_MAGIC)) == _FLAT_MAGIC
+    except IOError:
+        return False
+
+# Tables of flat containers loaded by this process, by filename
+_FLAT_TABLES = {}
+
+class FlatFile(object):
+    """Container that stores files uncompressed, one after another in a
+    single file, followed by a table of their offsets. Implements the
+    ZipFile interface. Files are read from a memory map of the container,
+    so reading them is only a matter of copying, and processes reading the
+    same container share the operating system's page cache."""
+
+    def __init__(self, filename, mode='r', compression=None,
+                 allowZip64=None):
+        if mode not in ('r', 'w', 'a'):
+            raise ValueError('Mode must be r or w or a')
+        self.filename = filename
+        self.mode = mode
+        self.mmap = None
+        self.subfiles = None
+        if mode == 'w' or (mode == 'a' and not os.path.exists(filename)):
+            self.fh = open(filename, 'wb')
+            self.fh.write(_FLAT_MAGIC)
+            self.names = []
+            self.members = {}
+        elif mode == 'r':
+            self.fh = open(filename, 'rb')
+            statobj = os.fstat(self.fh.fileno())
+            key = os.path.abspath(filename)
+            cached = _FLAT_TABLES.get(key)
+            if cached and cached[0] == (statobj.st_size, statobj.st_mtime):
+                self.names, self.members, self.subfiles = cached[1:]
+            else:
+                self.names, self.members, _ = self._read_table()
+                # Parse chunk names only once per process
+                self.subfiles = _subfile_index(
+                    _chunk_info(name, _chunk_prefix(name))
+                    for name in self.names if _chunk_prefix(name))
+                _FLAT_TABLES[key] = ((statobj.st_size, statobj.st_mtime),
+                                     self.names, self.members,
+                                     self.subfiles)
+            self.mmap = mmap(self.fh.fileno(), 0, access=ACCESS_READ)
+        else:
+            self.fh = open(filename, 'r+b')
+            self.names, self.members, table_off = self._read_table()
+            # New files are written over the table
+            self.fh.seek(table_off)
+            self.fh.truncate()
+
+    def _read_table(self):
+        """Return the names of the files in the container, a dictionary
+        mapping them to their (offset, size), and the offset of the
+        table."""
+        self.fh.seek(-_FLAT_TRAILER.size, 2)
+        table_off, nmembers, magic = \
+            _FLAT_TRAILER.unpack(self.fh.read(_FLAT_TRAILER.size))
+        if magic != _FLAT_MAGIC:
+            raise BadZipfile('%s is not a flat container' % self.filename)
+        self.fh.seek(table_off)
+        table = self.fh.read()
+        names = []
+        members = {}
+        offset = 0
+        for _ in xrange(nmembers):
+            fileoffset, size, namelen = _FLAT_MEMBER.unpack_from(table,
+                                                                 offset)
+            offset += _FLAT_MEMBER.size
+            name = table[offset:offset+namelen]
+            offset += namelen
+            names.append(name)
+            members[name] = (fileoffset, size)
+        return names, members, table_off
+
+    def close(self):
+        """Close the container. Must be called after writing to avoid data
+        loss."""
+        if self.mmap:
+            self.mmap.close()
+            self.mmap = None
+        if self.mode != 'r' and self.fh:
+            table_off = self.fh.tell()
+            for name in self.names:
+                offset, size = self.members[name]
+                self.fh.write(_FLAT_MEMBER.pack(offset, size, len(name)))
+                self.fh.write(name)
+            self.fh.write(_FLAT_TRAILER.pack(table_off, len(self.names),
+                                             _FLAT_MAGIC))
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+
+    def getinfo(self, filename):
+        """Return a ZipInfo-compatible structure with file metadata."""
+        return UnpackedZipInfo(file_size=self.members[filename][1])
+
+    def namelist(self):
+        """Return a list of the names of the files in the container."""
+        return list(self.names)
+
+    def chunk_index(self, prefix):
+        """Return the ChunkInfos of the chunks with prefix, and the lists
+        used to search them (see _subfile_index)."""
+        return self.subfiles.get(prefix, ([], [], [], []))
+
+    def read(self, filename):
+        """Return the contents of a file."""
+        offset, size = self.members[filename]
+        return self.mmap[offset:offset+size]
+
+    def writestr(self, filename, data):
+        """Add a file with contents data to the container."""
+        assert self.mode != 'r'
+        if filename not in self.members:
+            self.names.append(filename)
+        self.members[filename] = (self.fh.tell(), len(data))
+        self.fh.write(data)
+
 class ChunkedFile(object):
     """Compressed file writer/reader that stores data in chunks in a zip file.
-    Transparently supports reading gzip files.
+    Transparently supports reading gzip files, and storing chunks
+    uncompressed in an existing FlatFile container instead of a zip file.
     """
     def __init__(self, filename, subfile='', mode='r', chunksize=131072,
-                 autoflush=True):
+                 autoflush=True, codec=None, readahead=0, threads=0,
+                 cache=True):
         """Create a ChunkedFile object with given filename, I/O mode (r,w,a),
         and preferred chunk size. If you wish to manually control the chunk
-        boundaries using bookmark() or flush(), set autoflush=False."""
+        boundaries using bookmark() or flush(), set autoflush=False.
+        When writing to a zip file, codec selects the compression of the
+        chunks written (see get_codec; by default, zlib), and threads the
+        number of threads compressing chunks in parallel (by default, each
+        chunk is compressed as it is written). Chunks in a FlatFile are not
+        compressed.
+        When reading, readahead chunks following the current one can be
+        decompressed by a background thread while the caller processes the
+        current one, to speed up sequential scans of the whole file.
+        Chunks read are kept in the shared cache (CHUNK_CACHE) for other
+        readers, unless cache=False. Scans of the whole file should not
+        cache them, since they would evict the chunks that searches
+        reuse; chunks already in the cache are still used."""
         if mode not in 'rwa':
             raise ValueError('Mode must be r or w or a')
+        self.codec = get_codec(codec) if codec else None
         self._is_gzip = False
+        manifest = None
+        if mode == 'r':
+            statobj = os.stat(filename)
+            self._cachekey = (os.path.abspath(filename), statobj.st_mtime,
+                              statobj.st_size)
+            if not os.path.isdir(filename):
+                manifest = _load_manifest(filename, statobj)
         if os.path.isdir(filename):
             assert mode == 'r'
             self.zip = UnpackedZipFile(filename, mode)
+        elif manifest:
+            self.zip = ManifestZipFile(filename, manifest)
+        elif is_flatfile(filename):
+            self.zip = FlatFile(filename, mode)
         else:
             try:
                 self.zip = ZipFile(filename, mode, ZIP_DEFLATED)
             except BadZipfile:
                 assert mode == 'r'
-                # Transparent reading of gzip files
-                # (relatively fast, pure-python, some limitations)
-                self.zip = GzipFile(filename, mode)
+                # Transparent reading of gzip files, with random access
+                # through an index of access points
+                self.zip = IndexedGzipFile(filename)
                 self._is_gzip = True
         self.prefix = '%s/c.' % str(subfile) if subfile else 'c.'
         self.mode = mode
         self.chunksize = chunksize
         self.autoflush = autoflush
+        self.cache = cache
 
         # List of available chunks
-        if not self._is_gzip:
+        if mode == 'r' and hasattr(self.zip, 'chunk_index'):
+            (self.chunks, self._positions, self._bookmarks,
+             self._bookmarked) = self.zip.chunk_index(self.prefix)
+        elif not self._is_gzip:
             self.chunks = self._chunks()
+            self._index_chunks()
 
         # Determine current position
         if mode == 'r':
@@ -91,46 +667,148 @@ class ChunkedFile(object):
         else:
             self.pos = 0
 
-        # Buffers
-        self.nextbuf = []
+        # Buffers. Data is read from readbuf starting at readpos, which
+        # corresponds to pos in the file.
         self.readbuf = ''
+        self.readpos = 0
         self.writebuf = ''
         self._last_bookmark = None
 
+        # Read-ahead thread (see _start_readahead), started when the first
+        # chunk is loaded
+        self.readahead = readahead if mode == 'r' and not self._is_gzip \
+            and not isinstance(self.zip, FlatFile) else 0
+        self._readahead = None
+
+        # Thread pool compressing chunks, and the chunks being compressed
+        # (see _commit_chunks)
+        self.threads = threads if mode != 'r' and \
+            isinstance(self.zip, ZipFile) and _raw_zip_writes(self.zip) \
+            else 0
+        self._pool = ThreadPool(self.threads) if self.threads else None
+        self._pending = deque()
+
     def _chunks(self):
         """Return a list of ChunkInfos, one for each chunk in the file."""
-        offset = len(self.prefix)
         chunks = []
         for name in self.zip.namelist():
             # Check multifiles
             if not name[0:].startswith(self.prefix):
                 continue
-            nameinfo = name[offset:].split(',')
-            pos = int(nameinfo[0], 16)
-            bookmark = None
-            if len(nameinfo) > 1:
-                bookmark = urlsafe_b64decode(nameinfo[1])
-            chunks.append(ChunkInfo(name=name,
-                                    pos=pos,
-                                    bookmark=bookmark))
+            chunks.append(_chunk_info(name, self.prefix))
         return sorted(chunks, key=lambda chunk: chunk.pos)
 
-    def _next_chunk(self):
-        """Read the next chunk into the read buffer."""
+    def _index_chunks(self):
+        """Build the sorted lists used by seek and find_bookmark to search
+        self.chunks (see _chunk_index)."""
+        (self._positions, self._bookmarks,
+         self._bookmarked) = _chunk_index(self.chunks)
+
+    def _add_chunk_index(self, idx, chunk):
+        """Add the idx-th chunk (the last one) to the lists used for
+        searching."""
+        self._positions.append(chunk.pos)
+        if chunk.bookmark:
+            self._bookmarks.append(chunk.bookmark)
+            self._bookmarked.append(idx)
+
+    def _load_chunk(self):
+        """Return the data of the next chunk, or raise EOFError."""
         if self._is_gzip:
             chunk = self.zip.read(self.chunksize)
             if not chunk:
                 self.eof = True
                 raise EOFError
-            else:
-                self.readbuf += chunk
-            return
+            return chunk
         self.chunkidx += 1
         if self.chunkidx >= len(self.chunks):
             self.eof = True
             raise EOFError
+        if self.readahead:
+            return self._readahead_chunk()
+        return self._get_chunk(self.chunkidx)
+
+    def _get_chunk(self, idx):
+        """Return the data of the idx-th chunk."""
+        name = self.chunks[idx].name
+        if isinstance(self.zip, FlatFile):
+            return self.zip.read(name)  # Nothing to decompress
+        return CHUNK_CACHE.get(self._cachekey + (name,),
+                               lambda: self._read_chunk(name),
+                               store=self.cache)
+
+    def _start_readahead(self):
+        """Start a thread loading the chunks from the current one onward
+        into a queue of up to self.readahead chunks. While it runs, only the
+        thread reads from the container."""
+        queue = Queue(self.readahead)
+        stop = Event()
+        thread = Thread(target=self._readahead_worker,
+                        args=(self.chunkidx, queue, stop))
+        thread.daemon = True
+        thread.start()
+        self._readahead = (self.chunkidx, queue, stop, thread)
+
+    def _readahead_worker(self, idx, queue, stop):
+        """Put (index, data) of each chunk from the idx-th onward in queue,
+        until the last chunk or until stop is set. If loading a chunk
+        fails, the exception is put in place of its data."""
+        while idx < len(self.chunks) and not stop.is_set():
+            try:
+                data = self._get_chunk(idx)
+            except Exception as e:
+                data = e
+            while not stop.is_set():
+                try:
+                    queue.put((idx, data), timeout=0.1)
+                    break
+                except Full:
+                    pass
+            if isinstance(data, Exception):
+                break
+            idx += 1
+
+    def _stop_readahead(self):
+        """Stop the read-ahead thread, if any."""
+        if self._readahead:
+            _, _, stop, thread = self._readahead
+            stop.set()
+            thread.join()
+            self._readahead = None
+
+    def _readahead_chunk(self):
+        """Return the data of the current chunk, from the read-ahead thread
+        (which is restarted if the file has been seeked)."""
+        if self._readahead and self._readahead[0] != self.chunkidx:
+            self._stop_readahead()
+        if not self._readahead:
+            self._start_readahead()
+        _, queue, stop, thread = self._readahead
+        idx, data = queue.get()
+        assert idx == self.chunkidx
+        self._readahead = (idx+1, queue, stop, thread)
+        if isinstance(data, Exception):
+            self._stop_readahead()
+            raise data
+        return data
+
+    def _read_chunk(self, name):
+        """Read and decompress the chunk name."""
+        try:
+            return self.zip.read(name)
+        except NotImplementedError:
+            # Compressed by a codec that ZipFile does not support
+            return _read_compressed(self.zip, name)
+
+    def _next_chunk(self):
+        """Read the next chunk into the read buffer, discarding data that
+        has already been read."""
+        chunk = self._load_chunk()
+        if self.readpos < len(self.readbuf):
+            self.readbuf = self.readbuf[self.readpos:] + chunk
         else:
-            self.readbuf += self.zip.read(self.chunks[self.chunkidx].name)
+            self.readbuf = chunk
+        self.readpos = 0
 
     def _flush(self, auto=True, bookmark=None):
         """Flush complete chunks from the write buffer. An incomplete chunk
@@ -148,20 +826,53 @@ class ChunkedFile(object):
             if bookmark and len(self.writebuf) <= self.chunksize:
                 chunkname += ','+urlsafe_b64encode(bookmark)
                 chunkbookmark = bookmark
-            self.zip.writestr(chunkname, self.writebuf[:self.chunksize])
+            self._write_chunk(chunkname, self.writebuf[:self.chunksize])
             self.writebuf = self.writebuf[self.chunksize:]
             self.chunks.append(ChunkInfo(name=chunkname,
                                          pos=chunkpos,
                                          bookmark=chunkbookmark))
+            self._add_chunk_index(self.chunkidx, self.chunks[-1])
+
+    def _write_chunk(self, name, data):
+        """Write the chunk name to the container, compressing it (or having
+        the thread pool compress it, to be written by _commit_chunks)."""
+        if self._pool:
+            codec = self.codec or get_codec('zlib')
+            self._pending.append((name, data, codec.compress_type,
+                                  self._pool.apply_async(codec.compress,
+                                                         (data,))))
+            # Bound the memory used by chunks waiting to be written
+            self._commit_chunks(2*self.threads)
+        elif self.codec and isinstance(self.zip, ZipFile):
+            _writestr_compressed(self.zip, name, data,
+                                 self.codec.compress_type,
+                                 self.codec.compress(data))
+        else:
+            self.zip.writestr(name, data)
+
+    def _commit_chunks(self, maxpending=0):
+        """Write chunks compressed by the thread pool to the container, in
+        the order they were created: all that are ready, and enough that at
+        most maxpending remain."""
+        while self._pending and (len(self._pending) > maxpending or
+                                 self._pending[0][3].ready()):
+            name, data, compress_type, result = self._pending.popleft()
+            _writestr_compressed(self.zip, name, data, compress_type,
+                                 result.get())
 
     def close(self):
         """Close the file. Must be called to avoid data loss."""
         self.flush()
+        self._stop_readahead()
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
         self.zip.close()
 
     def flush(self):
         """Flush all output to the file."""
         self._flush(auto=False)
+        self._commit_chunks()
 
     def bookmark(self, bookmark):
         """Possibly flush the file, writing a bookmark if doing so."""
@@ -179,54 +890,96 @@ class ChunkedFile(object):
         self.pos += len(data)
         self._flush(auto=True)
 
+    def _consume(self, size, keep):
+        """Advance size bytes (or to the end of the file, if size < 0),
+        returning the data if keep is True."""
+        pieces = []
+        length = 0
+        buf = self.readbuf
+        start = self.readpos
+        while True:
+            avail = len(buf) - start
+            if size >= 0 and length + avail >= size:
+                end = start + size - length
+                if keep:
+                    pieces.append(buf[start:end])
+                length = size
+                break
+            if keep and avail:
+                pieces.append(buf[start:] if start else buf)
+            length += avail
+            try:
+                buf = self._load_chunk()
+            except EOFError:
+                buf = ''
+                end = 0
+                break
+            start = 0
+        self.readbuf = buf
+        self.readpos = end
+        self.pos += length
+        if keep:
+            return pieces[0] if len(pieces) == 1 else ''.join(pieces)
+
     def read(self, size=-1):
         """Read data from the file."""
-        try:
-            while size < 0 or len(self.readbuf) < size:
-                self._next_chunk()
-        except EOFError:
-            pass
-        if size > 0:
-            ret = self.readbuf[:size]
-            self.readbuf = self.readbuf[size:]
-        elif size < 0:
-            ret = self.readbuf
-            self.readbuf = ''
-        elif size == 0:
-            ret = ''
-        self.pos += len(ret)
-        return ret
+        return self._consume(size, True)
 
     def next(self):
         """Return the next line from the file or raise StopIteration."""
-        if self.nextbuf:
-            self.pos += len(self.nextbuf[0])
-            return self.nextbuf.pop(0)
-        if self.eof and not self.readbuf:
-            raise StopIteration
         # Find next line ending
-        try:
-            while '\n' not in self.readbuf:
+        end = self.readbuf.find('\n', self.readpos)
+        while end < 0:
+            searched = len(self.readbuf) - self.readpos
+            try:
                 self._next_chunk()
-        except EOFError:
-            if '\n' not in self.readbuf:
-                if self.readbuf:
+            except EOFError:
+                if self.readpos < len(self.readbuf):
                     return self.read(-1)
-                else:
-                    raise StopIteration
+                raise StopIteration
+            end = self.readbuf.find('\n', searched)
+        end += 1
+        line = self.readbuf[self.readpos:end]
+        self.readpos = end
+        self.pos += len(line)
+        return line
 
-        # Split lines into separate buffer
-        self.nextbuf = self.readbuf.splitlines(True)
-        if self.readbuf[-1] != '\n':
-            self.readbuf = self.nextbuf.pop()
-        else:
-            self.readbuf = ''
-        return self.next()
+    def iter_lines_with_offsets(self):
+        """Iterate over the lines of the file, from the current position,
+        yielding (pos, line) where pos is the position of the start of line
+        (as from tell()). Faster than iterating over the file and calling
+        tell() for each line. The file may be read or seeked between lines;
+        iteration continues from the new position."""
+        while True:
+            buf = self.readbuf
+            start = self.readpos
+            pos = self.pos
+            end = buf.find('\n', start)
+            if end < 0:
+                # Read more of the file
+                try:
+                    line = self.next()
+                except StopIteration:
+                    return
+                yield pos, line
+                continue
+            find = buf.find
+            while end >= 0:
+                end += 1
+                self.readpos = end
+                self.pos = nextpos = pos + end - start
+                yield pos, buf[start:end]
+                if self.readpos != end or self.readbuf is not buf:
+                    break       # The caller has moved within the file
+                pos = nextpos
+                start = end
+                end = find('\n', start)
 
     def seek(self, offset, whence=0):
         """Seek to a given byte position in the file. Currently limited to
         files opened for mode=r and whence current location or beginning of
-        the file."""
+        the file. In gzip files, seeking resumes decompression from the
+        nearest access point (see gzipindex)."""
         # Only simple writing is supported
         assert(self.mode == 'r')
         if whence == 0:
@@ -238,38 +991,56 @@ class ChunkedFile(object):
         else:
             raise ValueError
         if self._is_gzip:
-            assert(offset >= self.pos)
+            bufstart = self.pos - self.readpos
+            if not bufstart <= offset <= bufstart + len(self.readbuf):
+                self.zip.seek(offset)
+                self.readbuf = ''
+                self.readpos = 0
+                self.pos = offset
+                self.eof = False
+            elif offset < self.pos:
+                # Within the read buffer
+                self.readpos -= self.pos - offset
+                self.pos = offset
         else:
-            # Find the correct chunk
+            # Find the correct chunk: the last one starting at or before
+            # offset
             self.flush()
-            self.nextbuf = []
             self.readbuf = ''
-            self.chunkidx = -1
-            self.pos = 0
-            for idx, data in enumerate(self.chunks):
-                if data.pos <= offset:
-                    self.chunkidx = idx-1
-                    self.pos = data.pos
+            self.readpos = 0
+            idx = bisect_right(self._positions, offset) - 1
+            if idx >= 0:
+                self.chunkidx = idx-1
+                self.pos = self.chunks[idx].pos
+            else:
+                self.chunkidx = -1
+                self.pos = 0
         delta = offset-self.pos
         assert(delta >= 0)
-        self.read(delta)
+        self._consume(delta, False)
         assert(delta <= self.chunksize or self.eof or self._is_gzip)
         assert(self.pos == offset)
 
     def find_bookmark(self, bookmark, give_range=False):
-        """Determine an appropriate seek position near bookmark."""
+        """Determine an appropriate seek position near bookmark. With
+        give_range=True, return a tuple (start, end) of seek positions
+        between which bookmark must be found (end is None at the end of the
+        file)."""
+        # Bookmarks are written in increasing order, so the bookmarked
+        # chunks are sorted by bookmark as well as by position. Start at the
+        # last chunk with a bookmark before bookmark...
         pos = 0
-        for chunk in self.chunks:
-            if chunk.bookmark and chunk.bookmark < bookmark:
-                pos = chunk.pos
+        idx = bisect_left(self._bookmarks, bookmark)
+        if idx > 0:
+            pos = self.chunks[self._bookmarked[idx-1]].pos
         if give_range:
-            ret_next = 0
-            for chunk in self.chunks:
-                if ret_next == 1:
-                    assert(chunk.pos > pos)
-                    return pos, chunk.pos
-                elif chunk.bookmark and chunk.bookmark > bookmark:
-                    ret_next = 1
+            # ...and end after the first chunk with a bookmark after it.
+            idx = bisect_right(self._bookmarks, bookmark)
+            if idx < len(self._bookmarks) and \
+                    self._bookmarked[idx]+1 < len(self.chunks):
+                end = self.chunks[self._bookmarked[idx]+1].pos
+                assert(end > pos)
+                return pos, end
             return pos, None
         else:
             return pos
@@ -278,6 +1049,18 @@ class ChunkedFile(object):
         """Return the current byte position in the file."""
         return self.pos
 
+    def size(self):
+        """Return the size of the file. (For gzip files, this requires
+        decompressing the whole file the first time.)"""
+        if self.mode != 'r':
+            return self.pos
+        elif self._is_gzip:
+            return self.zip.size()
+        elif not self.chunks:
+            return 0
+        return self.chunks[-1].pos + \
+            self.zip.getinfo(self.chunks[-1].name).file_size
+
     # def __enter__(...): return self
     # def __exit__(...): self.close()
 
@@ -298,6 +1081,8 @@ def _main(argv):
     parser.add_argument('--append',
                         action='store_const', const='a', dest='mode',
                         help='Append data to file')
+    parser.add_argument('--codec', choices=CODECS.keys(),
+                        help='Compression of data written (default zlib)')
     parser.add_argument('file', nargs=1,
                         help='Container to read/write')
     parser.add_argument('subfile', nargs='?',
@@ -313,7 +1098,8 @@ def _main(argv):
             writefh.write(buf)
 
     if args.mode and args.mode in 'aw':
-        cfh = ChunkedFile(args.file[0], subfile=args.subfile, mode=args.mode)
+        cfh = ChunkedFile(args.file[0], subfile=args.subfile, mode=args.mode,
+                          codec=args.codec)
         move_data(sys.stdin, cfh)
         cfh.close()
     if args.read or not args.mode:
@@ -0,0 +1,240 @@
+"""columnstore - Per-title data stored in columns, by dense title ID."""
+
+from mmap import mmap, ACCESS_READ
+import os
+import struct
+from utils import dump_array, load_array
+
+# File layout (all integers little-endian):
+#   header   -- _HEADER (magic, number of titles and of columns, section
+#               offsets)
+#   titles   -- ntitles titles (UTF-8), sorted; the ID of a title is its
+#               position in this list
+#   titleidx -- ntitles+1 uint32 offsets of each title, relative to titles
+#   columns  -- ncolumns _COLUMN entries (name, typecode, offsets), followed
+#               by the data of each column: ntitles values of its typecode,
+#               for strings (typecode 's') the uint32 code of each value,
+#               and then the strings (UTF-8) and their offsets, as for the
+#               titles. Code 0 (and for numbers, _MISSING) is no value.
+_MAGIC = 'IMDBCOL1'
+_HEADER = struct.Struct('<8sIIQQQ')
+_COLUMN = struct.Struct('<32scQIQQ')
+
+# Types of column: 32-bit integers (signed or unsigned), floats, strings
+_TYPECODES = {'i': 'i', 'I': 'I', 'f': 'f', 's': 'I'}
+_MISSING = {'i': -2**31, 'I': 2**32-1}
+
+def _dump_strings(strings):
+    """Return the serialization of a list of strings and of their
+    offsets."""
+    offsets = load_array('I')
+    offsets.append(0)
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+    return ''.join(strings), dump_array(offsets)
+
+class ColumnStore(object):
+    """Reader/writer for a file of columns of per-title data, each holding
+    one value (or none) for every title, by title ID. Title IDs are dense
+    integers, assigned in order of title, so that the values of any number
+    of titles are found by indexing arrays."""
+
+    def __init__(self, filename, mode='r', titles=None):
+        """Open the column store filename for reading (mode=r, mapping it
+        from the file) or create it (mode=w) for titles, a list of titles
+        (UTF-8 strings)."""
+        if mode not in ('r', 'w'):
+            raise ValueError('Mode must be r or w')
+        self.filename = filename
+        self.mode = mode
+        self._arrays = {}
+        if mode == 'w':
+            self.fh = open(filename, 'wb')
+            self._titles = sorted(set(titles))
+            self.ntitles = len(self._titles)
+            self._columns = []
+            self.data = None
+        else:
+            self.fh = open(filename, 'rb')
+            self.data = mmap(self.fh.fileno(), 0, access=ACCESS_READ)
+            magic, self.ntitles, ncolumns, self._titles_off, \
+                self._titleidx_off, columns_off = \
+                _HEADER.unpack_from(self.data, 0)
+            if magic != _MAGIC:
+                raise ValueError('%s is not a column store' % filename)
+            self.columns = {}
+            for i in xrange(ncolumns):
+                name, typecode, data_off, nstrings, strings_off, \
+                    stringidx_off = _COLUMN.unpack_from(
+                        self.data, columns_off + i*_COLUMN.size)
+                self.columns[name.rstrip('\0')] = \
+                    (typecode, data_off, nstrings, strings_off, stringidx_off)
+
+    def add(self, name, typecode, values):
+        """Add the column name of values of typecode: 'i' or 'I' (signed or
+        unsigned 32-bit integers), 'f' (floats) or 's' (unicode strings).
+        values is a dictionary of the value of each title (a UTF-8 string);
+        titles not in the store are ignored. Values of None are not stored
+        (see gather)."""
+        assert self.mode == 'w'
+        if typecode not in _TYPECODES:
+            raise ValueError('Unknown column type %s' % typecode)
+        strings = []
+        if typecode == 's':
+            codes = {}
+            column = load_array('I', '\0' * (4*self.ntitles))
+            for i, title in enumerate(self._titles):
+                value = values.get(title)
+                if value is not None:
+                    if value not in codes:
+                        strings.append(value.encode('utf-8'))
+                        codes[value] = len(strings)
+                    column[i] = codes[value]
+        else:
+            missing = _MISSING.get(typecode, float('nan'))
+            column = load_array(typecode)
+            column.extend(missing if value is None else value
+                          for value in (values.get(title)
+                                        for title in self._titles))
+        self._columns.append((name, typecode, column, strings))
+
+    def close(self):
+        """Close the file. Must be called after writing to avoid data loss."""
+        if self.mode == 'w' and self.fh:
+            titles, titleidx = _dump_strings(self._titles)
+            titles_off = _HEADER.size
+            titleidx_off = titles_off + len(titles)
+            columns_off = titleidx_off + len(titleidx)
+            self.fh.write(_HEADER.pack(_MAGIC, self.ntitles,
+                                       len(self._columns), titles_off,
+                                       titleidx_off, columns_off))
+            self.fh.write(titles)
+            self.fh.write(titleidx)
+            pos = columns_off + len(self._columns)*_COLUMN.size
+            sections = []
+            for name, typecode, column, strings in self._columns:
+                data = dump_array(column)
+                strings, stringidx = _dump_strings(strings)
+                self.fh.write(_COLUMN.pack(name, typecode, pos,
+                                           len(stringidx)/4 - 1,
+                                           pos + len(data),
+                                           pos + len(data) + len(strings)))
+                sections += [data, strings, stringidx]
+                pos += len(data) + len(strings) + len(stringidx)
+            self.fh.write(''.join(sections))
+            self._columns = None
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+
+    def _string(self, rows_off, rowidx_off, i):
+        """Return the i-th of a list of strings (see the file layout)."""
+        start, end = struct.unpack_from('<II', self.data, rowidx_off + i*4)
+        return self.data[rows_off+start:rows_off+end]
+
+    def title(self, titleid):
+        """Return the title (a UTF-8 string) with ID titleid."""
+        start, end = struct.unpack_from('<II', self.data,
+                                        self._titleidx_off + titleid*4)
+        return self.data[self._titles_off+start:self._titles_off+end]
+
+    def lookup(self, titles):
+        """Return a dictionary of the IDs of those of titles (UTF-8 strings)
+        that are in the store. Titles are found in order, each searching
+        forward from the last (probing at increasing distances, then by
+        binary search), so a large batch reads few titles of the store for
+        each."""
+        title_at = self.title
+        ntitles = self.ntitles
+        ids = {}
+        low = 0
+        for title in sorted(set(titles)):
+            # Every title before low is less than title
+            high = low
+            step = 1
+            while high < ntitles and title_at(high) < title:
+                low = high + 1
+                high = low + step
+                step *= 2
+            high = min(high, ntitles)
+            while low < high:
+                mid = (low+high) // 2
+                if title_at(mid) < title:
+                    low = mid + 1
+                else:
+                    high = mid
+            if low < ntitles and title_at(low) == title:
+                ids[title] = low
+        return ids
+
+    def column(self, name):
+        """Return the array of the values of column name, by title ID (for
+        strings, the codes of the values; see strings). The array is loaded
+        by the first call and shared by later calls."""
+        if name not in self._arrays:
+            typecode, data_off = self.columns[name][0:2]
+            self._arrays[name] = load_array(
+                _TYPECODES[typecode],
+                self.data[data_off:data_off + 4*self.ntitles])
+        return self._arrays[name]
+
+    def missing(self, name):
+        """Return the value of the numeric column name of titles without a
+        value."""
+        return _MISSING.get(self.columns[name][0], float('nan'))
+
+    def strings(self, name):
+        """Return the list of the values of the string column name, by code
+        (None for code 0). The list is loaded by the first call and shared
+        by later calls."""
+        key = (name, 'strings')
+        if key not in self._arrays:
+            _, _, nstrings, strings_off, stringidx_off = self.columns[name]
+            self._arrays[key] = [None] + [
+                self._string(strings_off, stringidx_off, i).decode('utf-8')
+                for i in xrange(nstrings)]
+        return self._arrays[key]
+
+    def gather(self, name, titleids):
+        """Return the values of column name for each of titleids, or None for
+        titles without a value. Large batches are gathered from the whole
+        column (see column and strings), small ones from the file."""
+        typecode, data_off, _, strings_off, stringidx_off = \
+            self.columns[name]
+        whole = name in self._arrays or len(titleids) > self.ntitles // 64
+        if whole:
+            column = self.column(name)
+            values = [column[titleid] for titleid in titleids]
+            if typecode == 'I':
+                values = [int(value) for value in values]   # Not long
+        else:
+            unpack_from = struct.Struct('<' +
+                                        _TYPECODES[typecode]).unpack_from
+            values = [unpack_from(self.data, data_off + 4*titleid)[0]
+                      for titleid in titleids]
+        if typecode == 's' and whole:
+            strings = self.strings(name)
+            return [strings[code] for code in values]
+        elif typecode == 's':
+            return [self._string(strings_off, stringidx_off,
+                                 code-1).decode('utf-8') if code else None
+                    for code in values]
+        missing = _MISSING.get(typecode)
+        return [None if value == missing or value != value else value
+                for value in values]
+
+# Column stores opened by this process, by filename, modification time and
+# size
+_STORES = {}
+
+def get_store(filename):
+    """Return the ColumnStore filename, opened for reading and shared by
+    this process."""
+    statobj = os.stat(filename)
+    key = (os.path.abspath(filename), statobj.st_mtime, statobj.st_size)
+    if key not in _STORES:
+        _STORES[key] = ColumnStore(filename)
+    return _STORES[key]
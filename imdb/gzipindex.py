@@ -0,0 +1,163 @@
+"""gzipindex - Random access to gzip files through access points.
+
+Like zlib's examples/zran.c, an index of access points is built as a gzip
+file is decompressed: the state of the decompressor every SPACING bytes of
+uncompressed data, from which decompression can be resumed after a seek.
+Python's zlib module cannot restore a decompressor from a saved window (it
+has no inflatePrime or inflateSetDictionary), so access points are copies
+of zlib Decompress objects, kept in memory by this process and shared by
+all IndexedGzipFiles reading the same file.
+"""
+
+from bisect import bisect_right
+import os
+import zlib
+
+# Default distance between access points, in bytes of uncompressed data
+SPACING = 1024*1024
+
+# Amount of compressed data decompressed at a time
+_BLOCKSIZE = 64*1024
+
+# zlib window bits for decompressing a gzip member (with header)
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+class GzipIndex(object):
+    """Access points of a gzip file, added in order of position as the file
+    is decompressed. Each access point is the offset of the compressed data
+    following it and a copy of the decompressor after decompressing the
+    data before it (None at the start of the file)."""
+
+    def __init__(self, spacing=SPACING):
+        self.spacing = spacing
+        self.positions = [0]        # Uncompressed position of each point
+        self.points = [(0, None)]   # (compressed offset, decompressor)
+        self.size = None            # Uncompressed size, once known
+
+    def add(self, position, offset, decompressor):
+        """Add an access point at position (in the uncompressed data), if it
+        is at least spacing bytes after the last one."""
+        if position >= self.positions[-1] + self.spacing:
+            self.positions.append(position)
+            self.points.append((offset, decompressor.copy()))
+
+    def find(self, position):
+        """Return the index of the last access point at or before
+        position."""
+        return bisect_right(self.positions, position) - 1
+
+# Indexes built by this process, by filename, modification time and size
+_INDEXES = {}
+
+def get_index(filename, spacing=SPACING):
+    """Return the GzipIndex of filename, shared by this process."""
+    statobj = os.stat(filename)
+    key = (os.path.abspath(filename), statobj.st_mtime, statobj.st_size)
+    index = _INDEXES.get(key)
+    if index is None or index.spacing != spacing:
+        index = _INDEXES[key] = GzipIndex(spacing)
+    return index
+
+class IndexedGzipFile(object):
+    """Reader for gzip files supporting seeking to any position, by resuming
+    decompression from the nearest access point (see GzipIndex) instead of
+    from the start of the file. Concatenated gzip members are read as one
+    file."""
+
+    def __init__(self, filename, spacing=SPACING):
+        self.fh = open(filename, 'rb')
+        self.index = get_index(filename, spacing)
+        self._restart(0)
+
+    def _restart(self, point):
+        """Resume decompression from the point-th access point."""
+        offset, decompressor = self.index.points[point]
+        self.fh.seek(offset)
+        self._decompressor = decompressor.copy() if decompressor \
+            else zlib.decompressobj(_GZIP_WBITS)
+        # Decompressed data; buf starts at bufpos in the uncompressed file
+        self.buf = ''
+        self.bufpos = self.pos = self.index.positions[point]
+        self._eof = False
+
+    def _decompress(self, data):
+        """Return data decompressed, starting new members as required."""
+        out = ''
+        while data:
+            if self._decompressor is None:
+                # Between members: another member, or trailing padding
+                if not data.strip('\0'):
+                    break
+                self._decompressor = zlib.decompressobj(_GZIP_WBITS)
+            out += self._decompressor.decompress(data)
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = None
+        return out
+
+    def _fill(self):
+        """Decompress more data into the buffer, discarding the data before
+        the current position. Return False at the end of the file."""
+        if self._eof:
+            return False
+        data = self.fh.read(_BLOCKSIZE)
+        start = min(self.pos, self.bufpos + len(self.buf)) - self.bufpos
+        self.buf = self.buf[start:]
+        self.bufpos += start
+        if not data:
+            self._eof = True
+            self.index.size = self.bufpos + len(self.buf)
+            return False
+        self.buf += self._decompress(data)
+        if self._decompressor:
+            self.index.add(self.bufpos + len(self.buf), self.fh.tell(),
+                           self._decompressor)
+        return True
+
+    def close(self):
+        """Close the file."""
+        self.fh.close()
+
+    def read(self, size=-1):
+        """Read and return up to size bytes (or the rest of the file)."""
+        while (size < 0 or self.bufpos + len(self.buf) < self.pos + size) \
+                and self._fill():
+            pass
+        start = self.pos - self.bufpos
+        data = self.buf[start:start+size] if size >= 0 else self.buf[start:]
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        """Seek to a given byte position in the uncompressed file (whence=0)
+        or relative to the current position (whence=1)."""
+        if whence == 1:
+            offset += self.pos
+        elif whence != 0:
+            raise NotImplementedError
+        if offset < 0:
+            raise ValueError('Cannot seek to a negative position')
+        point = self.index.find(offset)
+        if offset < self.bufpos or \
+                self.index.positions[point] > self.bufpos + len(self.buf):
+            self._restart(point)
+        # Decompress (and discard) the data up to offset
+        self.pos = offset
+        while self.bufpos + len(self.buf) < offset and self._fill():
+            pass
+
+    def tell(self):
+        """Return the current position in the uncompressed file."""
+        return self.pos
+
+    def size(self):
+        """Return the size of the uncompressed file (decompressing, and
+        indexing, the rest of the file if it has not been read before)."""
+        if self.index.size is None:
+            pos = self.pos
+            if self.index.positions[-1] > self.bufpos + len(self.buf):
+                self._restart(len(self.index.points) - 1)
+            while self._fill():
+                self.pos = self.bufpos + len(self.buf)
+            self.seek(pos)
+        return self.index.size
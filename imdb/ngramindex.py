@@ -0,0 +1,328 @@
+"""ngramindex - Persistent n-gram posting lists for the search index."""
+
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from mmap import mmap, ACCESS_READ
+import struct
+from utils import dump_array, load_array
+
+# File layout (all integers little-endian):
+#   header   -- _HEADER (magic, gram size, counts, section offsets)
+#   rows     -- search index lines, exactly as written to the .idx file
+#   rowidx   -- nrows+1 uint32 offsets of each row, relative to rows
+#   keys     -- nkeys n-grams, sorted, each space-padded to the gram size
+#   keyidx   -- nkeys+1 uint32 offsets of each posting list, in entries
+#   postings -- uint32 row numbers, sorted within each posting list
+#   parts    -- nparts uint32 partition numbers, sorted, followed by
+#               nparts+1 uint32 row numbers of the first row of each
+# Version 1 files have the header fields up to postings_off, and no parts.
+_MAGIC = 'IMDBNGX2'
+_HEADER = struct.Struct('<8sIIIQQQQQIQ')
+_MAGIC_V1 = 'IMDBNGX1'
+_HEADER_V1 = struct.Struct('<8sIIIQQQQQ')
+# Row offsets and posting offsets are uint32, limiting the rows section and
+# the number of postings
+_MAX_UINT32 = 2**32 - 1
+
+def ngrams(searchable, size):
+    """Return the set of n-grams of length size indexed for searchable.
+    Strings shorter than size are indexed as a single (short) n-gram."""
+    if len(searchable) < size:
+        return set((searchable,)) if searchable else set()
+    return set(searchable[i:i+size]
+               for i in xrange(len(searchable)-size+1))
+
+class NgramIndex(object):
+    """Reader/writer for a file mapping n-grams of the SEARCHABLE field of
+    the search index to sorted lists of row numbers. The rows themselves
+    are stored in the same file, so candidate rows can be read directly
+    without scanning the whole search index.
+
+    Rows may be grouped into numbered partitions (such as the year of
+    each title), added in order of partition number, so that searches
+    can be restricted to the rows of some partitions."""
+
+    def __init__(self, filename, mode='r', size=5, memory=False):
+        """Open the n-gram index filename for reading (mode=r) or create it
+        (mode=w) with n-grams of length size. The size of an existing index
+        is taken from the file. If memory=True, the index is read into
+        memory instead of being mapped from the file."""
+        if mode not in ('r', 'w'):
+            raise ValueError('Mode must be r or w')
+        self.filename = filename
+        self.mode = mode
+        if mode == 'w':
+            self.size = size
+            self.nrows = 0
+            self.fh = open(filename, 'wb')
+            self.fh.write('\0' * _HEADER.size)
+            self._rowidx = load_array('I')
+            self._rowidx.append(0)
+            self._postings = defaultdict(lambda: load_array('I'))
+            self.parts = load_array('I')
+            self._partrows = load_array('I')
+            self.data = None
+        elif memory:
+            with open(filename, 'rb') as fh:
+                self.data = fh.read()
+            self.fh = None
+            self._read_header()
+        else:
+            self.fh = open(filename, 'rb')
+            self.data = mmap(self.fh.fileno(), 0, access=ACCESS_READ)
+            self._read_header()
+
+    def _read_header(self):
+        """Load the section offsets (and partition table) from the file
+        header."""
+        magic = self.data[0:len(_MAGIC)]
+        if magic == _MAGIC:
+            (_, self.size, self.nrows, self.nkeys, self._rows_off,
+             self._rowidx_off, self._keys_off, self._keyidx_off,
+             self._postings_off, nparts, parts_off) = \
+                _HEADER.unpack_from(self.data, 0)
+        elif magic == _MAGIC_V1:
+            (_, self.size, self.nrows, self.nkeys, self._rows_off,
+             self._rowidx_off, self._keys_off, self._keyidx_off,
+             self._postings_off) = _HEADER_V1.unpack_from(self.data, 0)
+            nparts, parts_off = 0, None
+        else:
+            raise ValueError('%s is not an n-gram index' % self.filename)
+        if nparts:
+            self.parts = load_array('I', self.data[parts_off:
+                                                   parts_off + nparts*4])
+            self._partrows = load_array('I', self.data[
+                parts_off + nparts*4:parts_off + nparts*8 + 4])
+        else:
+            self.parts = None
+
+    def add(self, searchable, line, partition=0):
+        """Append a row (line, which should end with a newline) to the
+        index, making it searchable by the n-grams of searchable. Rows
+        must be added in order of partition, a non-negative integer."""
+        assert self.mode == 'w'
+        if not self.parts or self.parts[-1] != partition:
+            if self.parts and self.parts[-1] > partition:
+                raise ValueError('Rows must be added in order of partition')
+            self.parts.append(partition)
+            self._partrows.append(self.nrows)
+        end = self._rowidx[-1] + len(line)
+        if end > _MAX_UINT32:
+            raise ValueError('Rows of %s exceed 4 GiB' % self.filename)
+        self.fh.write(line)
+        self._rowidx.append(end)
+        for gram in ngrams(searchable, self.size):
+            self._postings[gram].append(self.nrows)
+        self.nrows += 1
+
+    def close(self):
+        """Close the file. Must be called after writing to avoid data loss."""
+        if self.mode == 'w' and self.fh:
+            rows_off = _HEADER.size
+            rowidx_off = self.fh.tell()
+            self.fh.write(dump_array(self._rowidx))
+            keys = sorted(self._postings)
+            keys_off = self.fh.tell()
+            self.fh.write(''.join(key.ljust(self.size) for key in keys))
+            keyidx = load_array('I')
+            keyidx.append(0)
+            for key in keys:
+                end = keyidx[-1] + len(self._postings[key])
+                if end > _MAX_UINT32:
+                    raise ValueError('Postings of %s exceed 2**32 entries' %
+                                     self.filename)
+                keyidx.append(end)
+            keyidx_off = self.fh.tell()
+            self.fh.write(dump_array(keyidx))
+            postings_off = self.fh.tell()
+            for key in keys:
+                self.fh.write(dump_array(self._postings[key]))
+            parts_off = self.fh.tell()
+            self._partrows.append(self.nrows)
+            self.fh.write(dump_array(self.parts))
+            self.fh.write(dump_array(self._partrows))
+            self.fh.seek(0)
+            self.fh.write(_HEADER.pack(_MAGIC, self.size, self.nrows,
+                                       len(keys), rows_off, rowidx_off,
+                                       keys_off, keyidx_off, postings_off,
+                                       len(self.parts), parts_off))
+            self._postings = None
+        if isinstance(self.data, mmap):
+            self.data.close()
+        self.data = None
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+
+    def _key(self, i):
+        """Return the (padded) i-th n-gram."""
+        start = self._keys_off + i*self.size
+        return self.data[start:start+self.size]
+
+    def _posting_range(self, i):
+        """Return the start and end of the i-th posting list, in entries."""
+        return struct.unpack_from('<II', self.data, self._keyidx_off + i*4)
+
+    def _bisect_posting(self, start, end, rowid):
+        """Return the position of the first entry at least rowid among
+        entries start to end (a sorted part of the postings)."""
+        while start < end:
+            mid = (start+end) // 2
+            if struct.unpack_from('<I', self.data,
+                                  self._postings_off + mid*4)[0] < rowid:
+                start = mid + 1
+            else:
+                end = mid
+        return start
+
+    def _posting_ranges(self, i, rows=None):
+        """Return a list of (start, end) ranges of the entries of the i-th
+        posting list, limited to the entries in rows, a list of (first,
+        end) ranges of row numbers in ascending order (default all
+        rows)."""
+        start, end = self._posting_range(i)
+        if rows is None:
+            return [(start, end)]
+        return [(self._bisect_posting(start, end, first),
+                 self._bisect_posting(start, end, last))
+                for first, last in rows]
+
+    def _posting(self, i, rows=None):
+        """Return the posting list of the i-th n-gram (limited to rows; see
+        _posting_ranges)."""
+        ret = load_array('I')
+        for start, end in self._posting_ranges(i, rows):
+            ret.extend(load_array('I', self.data[
+                self._postings_off + start*4:self._postings_off + end*4]))
+        return ret
+
+    def _find_key(self, gram):
+        """Return the position of gram in the sorted key table, or None."""
+        key = gram.ljust(self.size)
+        low, high = 0, self.nkeys
+        while low < high:
+            mid = (low+high) // 2
+            if self._key(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.nkeys and self._key(low) == key:
+            return low
+        return None
+
+    def _keys_containing(self, gram):
+        """Yield the positions of all keys that contain gram."""
+        start = self._keys_off
+        end = start + self.nkeys*self.size
+        pos = self.data.find(gram, start, end)
+        while pos >= 0:
+            offset = (pos-start) % self.size
+            if offset + len(gram) <= self.size:
+                yield (pos-start) // self.size
+            pos = self.data.find(gram, pos+1, end)
+
+    def _key_positions(self, gram):
+        """Return the positions of the keys whose posting lists together
+        list the rows containing gram. Grams shorter than the index n-gram
+        size are matched against every key (like a substring search);
+        longer grams are not supported."""
+        if len(gram) > self.size:
+            raise ValueError('n-gram "%s" is longer than %d' %
+                             (gram, self.size))
+        if len(gram) == self.size:
+            i = self._find_key(gram)
+            return [i] if i is not None else []
+        return list(self._keys_containing(gram))
+
+    def _frequency(self, positions, rows=None):
+        """Return the total length of the posting lists at positions
+        (limited to rows; see _posting_ranges)."""
+        total = 0
+        for i in positions:
+            for start, end in self._posting_ranges(i, rows):
+                total += end - start
+        return total
+
+    def _rows(self, positions, rows=None):
+        """Return the sorted union of the posting lists at positions
+        (limited to rows; see _posting_ranges)."""
+        if len(positions) == 1:
+            return self._posting(positions[0], rows)
+        ret = set()
+        for i in positions:
+            ret.update(self._posting(i, rows))
+        return sorted(ret)
+
+    def partition_rows(self, first, last):
+        """Return the (first, end) range of row numbers of the rows in
+        partitions first to last, inclusive. If the index has no partition
+        table, all rows are returned."""
+        if self.parts is None:
+            return (0, self.nrows)
+        return (self._partrows[bisect_left(self.parts, first)],
+                self._partrows[bisect_right(self.parts, last)])
+
+    def frequency(self, gram, rows=None):
+        """Return the number of rows containing gram (its document
+        frequency), from the lengths of the posting lists stored in the
+        index. For grams shorter than the n-gram size, this is an upper
+        bound, since a row may contain several keys that contain gram.
+        rows optionally limits the rows counted (see _posting_ranges)."""
+        return self._frequency(self._key_positions(gram), rows)
+
+    def lookup(self, gram, rows=None):
+        """Return the sorted row numbers of rows containing gram. (See
+        _key_positions for grams that are not of the n-gram size, and
+        _posting_ranges for rows.)"""
+        return self._rows(self._key_positions(gram), rows)
+
+    def candidates(self, grams, min_candidates=None, rows=None):
+        """Return the sorted row numbers of rows containing any of grams, a
+        list of n-grams or of tuples of n-grams (such as the n-grams of
+        each word of a query). rows optionally limits the rows returned,
+        as a list of (first, end) ranges of row numbers (see
+        partition_rows). See candidates for min_candidates."""
+        return candidates([(self, rows)], grams, min_candidates)[0]
+
+    def row(self, rowid):
+        """Return the line stored as row number rowid."""
+        start, end = struct.unpack_from('<II', self.data,
+                                        self._rowidx_off + rowid*4)
+        return self.data[self._rows_off+start:self._rows_off+end]
+
+def candidates(shards, grams, min_candidates=None):
+    """Return, for each of shards, the sorted row numbers of the rows of
+    that shard containing any of grams, a list of n-grams or of tuples of
+    n-grams (such as the n-grams of each word of a query). shards lists the
+    shards of an n-gram index as (NgramIndex, rows) pairs, where rows
+    limits the rows returned from that shard (see NgramIndex.candidates).
+    If min_candidates is given, n-grams are used in order of increasing
+    frequency (rarest first), and more common n-grams are only used while
+    fewer than min_candidates rows have been found, or while the rows found
+    contain n-grams of only one of the tuples (so that a misspelled word
+    cannot select all of the candidates). Frequencies and rows are counted
+    over all of the shards, so the n-grams used do not depend on how the
+    index is sharded."""
+    ordered = []
+    for i, group in enumerate(grams):
+        if isinstance(group, basestring):
+            group = (group,)
+        for gram in set(group):
+            positions = [index._key_positions(gram) for index, _ in shards]
+            frequency = sum(index._frequency(keys, rows) for (index, rows),
+                            keys in zip(shards, positions))
+            ordered.append((frequency, i, gram, positions))
+    ordered.sort()
+    mingroups = min(2, len(grams))
+    found = [set() for _ in shards]
+    groups = set()
+    for frequency, i, _, positions in ordered:
+        if min_candidates and len(groups) >= mingroups and \
+                sum(len(rowids) for rowids in found) >= min_candidates:
+            break
+        if frequency:
+            for (index, rows), keys, rowids in zip(shards, positions,
+                                                   found):
+                rowids.update(index._rows(keys, rows))
+            groups.add(i)
+    return [sorted(rowids) for rowids in found]
@@ -1,10 +1,14 @@
 """parsers - Parsers for IMDB data files."""
 
+from bisect import bisect_right
 from collections import Counter, namedtuple, defaultdict
+from itertools import izip, repeat
 import os.path
 import re
 
 from chunkedfile import ChunkedFile
+import columnstore
+from titleindex import TitleIndex
 from utils import Timer, open_compressed
 
 # Data types
@@ -12,6 +16,14 @@ IMDbRating = namedtuple('IMDbRating',
                         ('distribution', 'nratings', 'score'))
 IMDbPlot = namedtuple('IMDbPlot', ('summary, byline'))
 
+# Number of titles between the entries of the sparse index of data files
+# without an index (see _find_seeks_sparse)
+SPARSE_INTERVAL = 16
+
+# Number of chunks of a data file decompressed ahead, by a background thread,
+# when the whole file is read (see ChunkedFile)
+READAHEAD = 4
+
 # Parser enumeration
 def parsers():
     """Return a list of available parsers in the form (parsername, parser)."""
@@ -115,6 +127,7 @@ def _find_seeks_index(dbfile, indexname, queries, debug=False):
         print "  Searching index..."
     indexfh = ChunkedFile(dbfile, indexname, mode='r')
     last_bookmark = 0
+    found = set()   # Lines may be read again after seeking to a bookmark
     for query in sorted(queries):
         # Use bookmarks to rapidly search the index!
         bookmark = indexfh.find_bookmark(query.encode('utf-8'))
@@ -126,8 +139,9 @@ def _find_seeks_index(dbfile, indexname, queries, debug=False):
             title, nums = line.decode('utf-8').split('\t')
             if i % 100 == 0:
                 timer.step()
-            if title in queries:
+            if title in queries and title not in found:
                 locs.update(int(x) for x in nums.split(' '))
+                found.add(title)
             elif title > query:
                 break   # This works because the index is sorted.
     indexfh.close()
@@ -136,30 +150,38 @@ def _find_seeks_index(dbfile, indexname, queries, debug=False):
     if debug:
         print '  Completed in', timer, 'seconds.'
 
-def _find_seeks_bookmarks(fileobj, queries, debug=False):
-    """Use bookmarks to find sections of the file that *may* contain
-    the data we're looking for. End locations are required to ensure
-    prompt termination, since we have no idea if the file contains the
-    information we're looking for."""
+def _find_seeks_titleindex(filename, queries, debug=False):
+    """Use a binary title index (see titleindex.TitleIndex), holding the
+    same seek positions as the index file, to find them for relevant
+    records without parsing the index file (see _find_seeks_index)."""
     timer = Timer()
     locs = Counter()
-    endlocs = {}
     if debug:
-        print "  Searching bookmarks..."
-    for query in sorted(queries):
-        start, end = fileobj.find_bookmark(query.encode('utf-8'),
-                                           give_range=True)
-        #print "Got",start,end,"for",query.encode('utf-8')
-        if not end:
-            endlocs[start] = None   # None = EOF
-        elif start not in endlocs or endlocs[start] < end:
+        print "  Searching title index..."
+    index = TitleIndex(filename)
+    for query in queries:
+        locs.update(index.lookup(query.encode('utf-8')))
+    index.close()
+    for start, nresults in sorted(locs.items()):
+        yield (start, None, nresults)
+    if debug:
+        print '  Completed in', timer, 'seconds.'
+
+def _merge_ranges(ranges):
+    """Normalize ranges, a list of (start, end) ranges of seek positions
+    (end may be None for EOF), one for each query, to a non-overlapping set
+    of ranges, some of which may be infinite. Yields (start, end, nresults)
+    for each, where nresults is the number of queries in the range."""
+    locs = Counter()
+    endlocs = {}
+    for start, end in ranges:
+        if end is None:             # None = EOF
+            endlocs[start] = None
+        elif start not in endlocs or (endlocs[start] is not None and
+                                      endlocs[start] < end):
             endlocs[start] = end
-        #print '  ',endlocs[start]
         locs.update((start,))
 
-    # Because of the inexact nature of bookmarks, we need to normalize
-    # the locations to a non-overlapping set of ranges, some of which
-    # may be infinite.
     start = 0
     end = 0
     nresults = 0
@@ -186,9 +208,135 @@ def _find_seeks_bookmarks(fileobj, queries, debug=False):
     if nresults > 0:
         #assert(end is None or end > start)
         yield (start, end, nresults)
+
+def _find_seeks_bookmarks(fileobj, queries, debug=False):
+    """Use bookmarks to find sections of the file that *may* contain
+    the data we're looking for. End locations are required to ensure
+    prompt termination, since we have no idea if the file contains the
+    information we're looking for."""
+    timer = Timer()
+    if debug:
+        print "  Searching bookmarks..."
+    ranges = [fileobj.find_bookmark(query.encode('utf-8'), give_range=True)
+              for query in sorted(queries)]
+    # Because of the inexact nature of bookmarks, we need to normalize
+    # the locations to a non-overlapping set of ranges, some of which
+    # may be infinite.
+    for loc in _merge_ranges(ranges):
+        yield loc
     if debug:
         print '  Completed in', timer, 'seconds.'
 
+# Sparse indexes loaded by this process, by database file (and its
+# modification time and size) and index name
+_SPARSE_INDEXES = {}
+
+def _load_sparse_index(dbfile, sparsename):
+    """Return the sparse index sparsename of dbfile (see _find_seeks_sparse)
+    as sorted lists of titles and of their positions, or None if the
+    database does not have it."""
+    statobj = os.stat(dbfile)
+    key = (os.path.abspath(dbfile), statobj.st_mtime, statobj.st_size,
+           sparsename)
+    if key not in _SPARSE_INDEXES:
+        indexfh = ChunkedFile(dbfile, sparsename, mode='r')
+        titles = []
+        positions = []
+        if indexfh.chunks:
+            for line in indexfh.read().splitlines():
+                title, loc = line.rsplit('\t', 1)
+                titles.append(title)
+                positions.append(int(loc, 10))
+        indexfh.close()
+        _SPARSE_INDEXES[key] = (titles, positions) if titles else None
+    return _SPARSE_INDEXES[key]
+
+def _find_seeks_sparse(sparse, queries, debug=False):
+    """Use a sparse index, the positions of the first lines of every
+    SPARSE_INTERVAL-th title of a sorted data file (from
+    _load_sparse_index), to find the sections of the file containing the
+    data for queries: from the last indexed title before each query to the
+    next. Queries before the first title cannot be in the file, and are
+    skipped."""
+    timer = Timer()
+    if debug:
+        print "  Searching sparse index..."
+    titles, positions = sparse
+    ranges = []
+    for query in sorted(queries):
+        idx = bisect_right(titles, query.encode('utf-8'))
+        if idx == 0:
+            continue
+        ranges.append((positions[idx-1],
+                       positions[idx] if idx < len(positions) else None))
+    for loc in _merge_ranges(ranges):
+        yield loc
+    if debug:
+        print '  Completed in', timer, 'seconds.'
+
+def _find_seeks_bisect(fileobj, parse_line, queries, debug=False):
+    """Use binary search to find the sections of fileobj (a ChunkedFile,
+    positioned at the first line of data) containing the data for queries.
+    The lines must be sorted by title, as returned by parse_line (which must
+    not depend on previous lines). Used to search original data files,
+    which have no bookmarks."""
+    timer = Timer()
+    if debug:
+        print "  Searching by bisection..."
+    first = fileobj.tell()
+    size = fileobj.size()
+
+    def title_at(pos):
+        """Return the title of the first line starting at or after pos that
+        has one (or None at the end of the data), and the positions of that
+        line and the next."""
+        if pos > first:
+            # Skip the rest of the line containing pos-1
+            fileobj.seek(pos-1)
+            lines = fileobj.iter_lines_with_offsets()
+            next(lines, None)
+        else:
+            fileobj.seek(first)
+            lines = fileobj.iter_lines_with_offsets()
+        for loc, line in lines:
+            data = parse_line(line.rstrip().decode('iso-8859-1'), loc)
+            if data is None:
+                return None, loc, loc   # End of database
+            elif data:
+                return data[0], loc, loc + len(line)
+        return None, size, size
+
+    low = first
+    for query in sorted(queries):
+        # Find the first line with a title at least query; every line
+        # before low has a lesser title. Since queries are sorted, probe
+        # forward from low at increasing distances first, to avoid seeking
+        # backward.
+        high = low
+        step = 4096
+        while high < size:
+            high = min(max(low, high) + step, size)
+            title, loc, nextloc = title_at(high)
+            if title is None or title >= query:
+                break
+            low = nextloc
+            step *= 2
+        while low < high:
+            mid = (low+high) // 2
+            title, loc, nextloc = title_at(mid)
+            if title is not None and title < query and loc < high:
+                low = nextloc
+            else:
+                high = mid
+        title, start, end = title_at(low)
+        low = start
+        if title != query:
+            continue
+        while title == query:
+            title, loc, end = title_at(end)
+        yield (start, loc, 1)
+    if debug:
+        print '  Completed in', timer, 'seconds.'
 
 # Parser objects
 class _IMDbParser(object):
@@ -196,11 +344,23 @@ class _IMDbParser(object):
 
     filenames = []
     default = None
+    # Columns of the column store holding the search results of this
+    # parser by title ID, as (name, typecode) pairs (see create_columns)
+    columns = ()
 
     def __init__(self, dbfile, dbdir=None, debug=False):
         self.dbfile = dbfile
         self.listname = self.__class__.__name__[4:-6].lower()
         self.indexname = self.listname + '.index'
+        # Sparse index, used for data files without an index
+        self.sparsename = self.listname + '.sparse'
+        # Binary version of the index, stored beside the database
+        self.titleindexfile = '%s.%s.tix' % (dbfile, self.listname) \
+            if dbfile else None
+        self.columnsfile = dbfile + '.columns' if dbfile else None
+        # Binary index of the people of names data files (see
+        # _IMDbNamesParser.filmography)
+        self.nameindexfile = None
         if dbdir:
             self.origfiles = [os.path.join(dbdir, fn + '.list.gz') \
                 for fn in self.filenames]
@@ -209,12 +369,21 @@ class _IMDbParser(object):
         self.skip_tvvg = False
         self.debug = debug
 
-    def rebuild_index(self, do_copy=True):
+    def rebuild_index(self, do_copy=True, codecs=None, threads=0):
         """Create an index for this file, to allow rapid seeking to information
-        about a given title."""
+        about a given title. codecs optionally maps the names of the data
+        file and index (listname and indexname) to the codec used to
+        compress each (see chunkedfile.get_codec), and threads is the number
+        of threads compressing each in parallel. The index is also written
+        in binary, as titleindexfile, and for names data files, the people
+        are indexed in nameindexfile. Data files without an index are given
+        a sparse index (sparsename) instead."""
+        codecs = codecs or {}
         if do_copy:
             copy_to = ChunkedFile(self.dbfile, self.listname, mode='a',
-                                  autoflush=True if self.indexname else False)
+                                  autoflush=True if self.indexname else False,
+                                  codec=codecs.get(self.listname),
+                                  threads=threads)
             tellobj = copy_to
             filenames = self.origfiles
         else:
@@ -223,6 +392,10 @@ class _IMDbParser(object):
             raise NotImplementedError
 
         indexobj = defaultdict(list)
+        nameindex = defaultdict(list)
+        sparse = []
+        ntitles = 0
+        last_title = None
 
         for filename in filenames:
             if do_copy:
@@ -260,8 +433,19 @@ class _IMDbParser(object):
                 title = title.encode('utf-8')
                 if self.indexname:
                     indexobj[title].append(idxline)
+                    if self.nameindexfile:
+                        # Index the first line of each person's credits
+                        name = data[2][0].encode('utf-8')
+                        if nameindex[name][-1:] != [idxline]:
+                            nameindex[name].append(idxline)
                 elif copy_to:
                     copy_to.bookmark(title)
+                    # Index the first line of every SPARSE_INTERVAL-th title
+                    if title != last_title:
+                        if ntitles % SPARSE_INTERVAL == 0:
+                            sparse.append((title, idxline))
+                        ntitles += 1
+                        last_title = title
             fileobj.close()
         if copy_to:
             copy_to.close()
@@ -269,7 +453,9 @@ class _IMDbParser(object):
         if self.indexname:
             # Write out a separate index, if required (e.g. names databases)
             indexfh = ChunkedFile(self.dbfile, self.indexname, mode='a',
-                                  autoflush=False)
+                                  autoflush=False,
+                                  codec=codecs.get(self.indexname),
+                                  threads=threads)
             for title, linenos in sorted(indexobj.items()):
                 indexfh.write(title)
                 indexfh.write("\t")
@@ -277,10 +463,26 @@ class _IMDbParser(object):
                 indexfh.write("\n")
                 indexfh.bookmark(title)
             indexfh.close()
+            titleindex = TitleIndex(self.titleindexfile, mode='w')
+            for title, linenos in indexobj.iteritems():
+                titleindex.add(title, linenos)
+            titleindex.close()
+            if self.nameindexfile:
+                nameindexfh = TitleIndex(self.nameindexfile, mode='w')
+                for name, linenos in nameindex.iteritems():
+                    nameindexfh.add(name, linenos)
+                nameindexfh.close()
         else:
             # An index is required to use more than one file, since the
             # resulting combination will not be sorted
             assert(len(filenames) == 1)
+            if copy_to and sparse:
+                sparsefh = ChunkedFile(self.dbfile, self.sparsename, mode='a',
+                                       codec=codecs.get(self.sparsename),
+                                       threads=threads)
+                for title, loc in sparse:
+                    sparsefh.write('%s\t%d\n' % (title, loc))
+                sparsefh.close()
 
     def _run_search(self, queries):
         """Return items from the data file matching any item in queries."""
@@ -292,84 +494,159 @@ class _IMDbParser(object):
 
         # Open the compressed database, either copied version or original file.
         if self.dbfile:
-            fileobj = ChunkedFile(self.dbfile, self.listname, mode='r')
+            # A full scan reads ahead, and does not fill the chunk cache
+            fileobj = ChunkedFile(self.dbfile, self.listname, mode='r',
+                                  readahead=READAHEAD if queries is None
+                                  else 0, cache=queries is not None)
         else:
+            if queries and self.indexname:
+                raise NotImplementedError('%s must be converted (with '
+                                          'rebuild_index) to be searched' %
+                                          self.listname)
             assert(len(self.origfiles) == 1)
             try:
-                fileobj = open_compressed(self.origfiles[0])
-            except IOError as e:
+                if queries:
+                    # Random access to the original file, for bisection
+                    fileobj = ChunkedFile(self.origfiles[0], mode='r')
+                else:
+                    fileobj = open_compressed(self.origfiles[0])
+            except (IOError, OSError) as e:
                 print "Skipping %s: %s" % (self.origfiles[0], e.strerror)
                 return
             self._skip_header(fileobj)
         if self.debug:
             print "Reading %s..." % self.listname
 
-        # Locate seek positions for all queries
-        if queries and self.indexname:  # Use index
-            locs = list(_find_seeks_index(self.dbfile, self.indexname, queries,
-                                          debug=self.debug))
-        elif queries:                   # Use bookmarks
-            locs = list(_find_seeks_bookmarks(fileobj, queries,
-                                              debug=self.debug))
-        else:
-            locs = [(None, None, 1)]     # Dummy values to start loop
-
-        # Read selected lines from the file
-        timer = Timer()
-        loc = 0
-        for startloc, endloc, nresults in locs:
-            # Skip to the correct position in the file
-            if queries:
-                if startloc > loc:
-                    #print "  Seek to", startloc
-                    fileobj.seek(startloc)
-                    loc = fileobj.tell()
-                elif startloc < loc:
-                    #print "  Skipping", startloc, "already at", loc
-                    continue
-                #else:
-                #    print "  Skipping", startloc, "already there"
-                #print "    Finish at", endloc, "after", nresults, "results"
-            for _ in xrange(nresults):
-                # Parse the file until we get a result
-                for i, line in enumerate(fileobj):
-                    # Determine if we have reached the end location for this
-                    # section
-                    if endloc and loc == endloc:
-                        break
-                    #assert(not endloc or loc < endloc)
-
-                    # Do not index video games or individual TV episodes
-                    # (Not applicable for all file types)
-                    if not self.dbfile and self.skip_tvvg and \
-                            ('(VG)' in line or '{' in line):
-                        #loc = fileobj.tell() # Don't seek/tell in gzip
-                        continue
-                    # Decode database (IMDb databases use ISO-8859-1)
-                    line = line.rstrip().decode('iso-8859-1')
-
-                    if queries and i % 100 == 0:
-                        timer.step()
-
-                    data = self._parse_line(line, loc)
-                    if self.dbfile:
+        # Close the file (stopping any read-ahead) even if the caller
+        # stops iterating early
+        try:
+            # Locate seek positions for all queries
+            if queries and self.indexname and \
+                    os.path.exists(self.titleindexfile):  # Use binary index
+                locs = list(_find_seeks_titleindex(self.titleindexfile,
+                                                   queries, debug=self.debug))
+            elif queries and self.indexname:  # Use index
+                locs = list(_find_seeks_index(self.dbfile, self.indexname,
+                                              queries, debug=self.debug))
+            elif queries and self.dbfile:
+                sparse = self.sparsename and \
+                    _load_sparse_index(self.dbfile, self.sparsename)
+                if sparse:                  # Use sparse index
+                    locs = list(_find_seeks_sparse(sparse, queries,
+                                                   debug=self.debug))
+                else:                       # Use bookmarks
+                    locs = list(_find_seeks_bookmarks(fileobj, queries,
+                                                      debug=self.debug))
+            elif queries:                   # Search the sorted original file
+                locs = list(_find_seeks_bisect(fileobj, self._parse_line,
+                                               queries, debug=self.debug))
+            else:
+                locs = [(None, None, 1)]     # Dummy values to start loop
+
+            # Read selected lines from the file, with their positions (which
+            # are only needed, and only available, when seeking)
+            timer = Timer()
+            loc = 0
+            seekable = isinstance(fileobj, ChunkedFile)
+            if seekable:
+                lines = fileobj.iter_lines_with_offsets()
+            else:
+                lines = izip(repeat(0), fileobj)
+            for startloc, endloc, nresults in locs:
+                # Skip to the correct position in the file
+                if queries:
+                    if startloc > loc:
+                        #print "  Seek to", startloc
+                        fileobj.seek(startloc)
                         loc = fileobj.tell()
-
-                    if data is None:
-                        break           # End of database
-                    if not data:
-                        continue        # Skip this line
-
-                    # Check if one of our queries matches
-                    if queries is None or data[0] in queries:
-                        yield self._make_result(data)
-                        if queries is not None:
-                            # queries.remove(data[0])
+                    elif startloc < loc:
+                        #print "  Skipping", startloc, "already at", loc
+                        continue
+                    #else:
+                    #    print "  Skipping", startloc, "already there"
+                    #print "    Finish at", endloc, "after", nresults, \
+                    #    "results"
+                for _ in xrange(nresults):
+                    # Parse the file until we get a result
+                    for i, (loc, line) in enumerate(lines):
+                        # Determine if we have reached the end location for
+                        # this section (leaving the line to be read again
+                        # for the next section)
+                        if endloc is not None and loc == endloc:
+                            fileobj.seek(loc)
                             break
+                        #assert(not endloc or loc < endloc)
+
+                        # Do not index video games or individual TV episodes
+                        # (Not applicable for all file types)
+                        if not self.dbfile and self.skip_tvvg and \
+                                ('(VG)' in line or '{' in line):
+                            #loc = fileobj.tell() # Don't seek/tell in gzip
+                            continue
+                        nextloc = loc + len(line)
+                        # Decode database (IMDb databases use ISO-8859-1)
+                        line = line.rstrip().decode('iso-8859-1')
+
+                        if queries and i % 100 == 0:
+                            timer.step()
+
+                        data = self._parse_line(line, loc)
+                        if seekable:
+                            loc = nextloc
+
+                        if data is None:
+                            break           # End of database
+                        if not data:
+                            continue        # Skip this line
+
+                        # Check if one of our queries matches
+                        if queries is None or data[0] in queries:
+                            yield self._make_result(data)
+                            if queries is not None:
+                                # queries.remove(data[0])
+                                break
+
+            if self.debug:
+                print 'Completed in', timer, 'seconds.'
+        finally:
+            fileobj.close()
 
-        if self.debug:
-            print 'Completed in', timer, 'seconds.'
-        fileobj.close()
+    def _search_columns(self, queries):
+        """Return the search results of those of queries that are stored in
+        the column store, gathered by title ID, and a list of the remaining
+        queries (all of them, if the parser has no columns or the database
+        has no column store)."""
+        if queries is None or not self.columns or not self.columnsfile or \
+                not os.path.exists(self.columnsfile):
+            return {}, queries
+        queries = set(queries)
+        store = columnstore.get_store(self.columnsfile)
+        titleids = store.lookup(query.encode('utf-8') for query in queries)
+        found = []
+        remaining = []
+        for query in queries:
+            titleid = titleids.get(query.encode('utf-8'))
+            if titleid is None:
+                remaining.append(query)
+            else:
+                found.append((query, titleid))
+        results = {}
+        titleids = [titleid for _, titleid in found]
+        for (query, _), values in izip(found, izip(*[
+                store.gather(name, titleids) for name, _ in self.columns])):
+            result = self._from_columns(values)
+            if result is not None:
+                results[query] = result
+        return results, remaining
+
+    def _to_columns(self, result):
+        """Return the values of columns for a search result."""
+        return (result,)
+
+    def _from_columns(self, values):
+        """Return the search result whose values of columns are values, or
+        None if the title has no result."""
+        return values[0]
 
     def search(self, queries=None):
         """Perform a search, returning results after optional subclass-specific
@@ -473,6 +750,8 @@ class IMDbRatingParser(_IMDbParser):
     filenames = ['ratings']
     default = IMDbRating('..........', 0, '0')
     is_property = True
+    columns = (('rating_distribution', 's'), ('rating_nratings', 'I'),
+               ('rating_score', 's'))
 
     def __init__(self, dbfile=None, dbdir=None, debug=False):
         super(IMDbRatingParser, self).__init__(dbfile, dbdir, debug)
@@ -497,9 +776,17 @@ class IMDbRatingParser(_IMDbParser):
 
     #def _make_locator(self, data)
 
+    def _to_columns(self, result):
+        return tuple(result)
+
+    def _from_columns(self, values):
+        return IMDbRating(*values) if values[0] is not None else None
+
     def search(self, queries=None):
         # Return a dictionary
-        return dict(self._run_search(queries))
+        results, queries = self._search_columns(queries)
+        results.update(self._run_search(queries))
+        return results
 
 class IMDbPlotParser(_IMDbParser):
     """Parser for IMDb data file plot.."""
@@ -608,6 +895,7 @@ class IMDbColorInfoParser(_IMDbBasicParser):
 
     filenames = ['color-info']
     is_property = True
+    columns = (('color_info', 's'),)
 
     def __init__(self, dbfile=None, dbdir=None, debug=False):
         super(IMDbColorInfoParser, self).__init__(dbfile, dbdir, debug)
@@ -616,7 +904,9 @@ class IMDbColorInfoParser(_IMDbBasicParser):
     def search(self, queries=None):
         # Just return a dictionary, since there shouldn't be any duplicate
         # entries.
-        return dict(self._run_search(queries))
+        results, queries = self._search_columns(queries)
+        results.update(self._run_search(queries))
+        return results
 
 class IMDbGenresParser(_IMDbBasicParser):
     """Parser for IMDb data file genres."""
@@ -624,17 +914,27 @@ class IMDbGenresParser(_IMDbBasicParser):
     filenames = ['genres']
     default = []
     is_property = True
+    columns = (('genres', 's'),)
 
     def _skip_header(self, fileobj):
         return _skip_to(fileobj, '8: THE GENRES LIST', 2)
 
+    # Genres are stored in one column, separated by tabs
+    def _to_columns(self, result):
+        return ('\t'.join(result),)
+
+    def _from_columns(self, values):
+        return values[0].split('\t') if values[0] is not None else None
+
     def search(self, queries=None):
         # Return a dictionary that contains a sorted list of genres
+        results, queries = self._search_columns(queries)
         data = defaultdict(list)
         for title, value in self._run_search(queries):
             data[title].append(value)
         for datalist in data.values():
             datalist.sort()
+        data.update(results)
         return data
 
 class IMDbRunningTimeParser(_IMDbBasicParser):
@@ -642,6 +942,7 @@ class IMDbRunningTimeParser(_IMDbBasicParser):
 
     filenames = ['running-times']
     is_property = True
+    columns = (('running_time', 'i'),)
 
     def _make_result(self, (title, _, duration)):
         # Durations are of the form "[COUNTRY:]DURATION[:NUMBERS]"
@@ -672,12 +973,14 @@ class IMDbRunningTimeParser(_IMDbBasicParser):
 
     def search(self, queries=None):
         # Return a dictionary that contains the average running time
+        results, queries = self._search_columns(queries)
         data = defaultdict(list)
         for title, value in self._run_search(queries):
             data[title].append(value[0])
         for title in data.keys():
             data[title] = sorted(data[title])[int(len(data[title])/2)] # Median
             #data[title] = int(sum(data[title])/len(data[title])) # Mean
+        data.update(results)
         return data
 
 class IMDbCertificatesParser(_IMDbBasicParser):
@@ -686,6 +989,7 @@ class IMDbCertificatesParser(_IMDbBasicParser):
     filenames = ['certificates']
     is_property = True
     countries = ['USA']
+    columns = (('certificate', 's'), ('certificate_country', 's'))
 
     def __init__(self, dbfile=None, dbdir=None, debug=False):
         super(IMDbCertificatesParser, self).__init__(dbfile, dbdir, debug)
@@ -712,10 +1016,18 @@ class IMDbCertificatesParser(_IMDbBasicParser):
 
     # def _make_result(self, data)
 
+    def _to_columns(self, result):
+        return result
+
+    def _from_columns(self, values):
+        return tuple(values) if values[0] is not None else None
+
     def search(self, queries=None):
         # Just return a dictionary, since there shouldn't be any duplicate
         # entries. (FIXME: multiple supported countries)
-        return dict(self._run_search(queries))
+        results, queries = self._search_columns(queries)
+        results.update(self._run_search(queries))
+        return results
 
 
 class _IMDbNamesParser(_IMDbParser):
@@ -727,6 +1039,8 @@ class _IMDbNamesParser(_IMDbParser):
     def __init__(self, dbfile=None, dbdir=None, debug=False):
         super(_IMDbNamesParser, self).__init__(dbfile, dbdir, debug)
         self.last_person = (None, None)  # FIXME: not thread-safe
+        if dbfile:
+            self.nameindexfile = '%s.%s.names.tix' % (dbfile, self.listname)
 
     def _skip_header(self, fileobj):
         return _skip_to(fileobj, "----\t\t\t------", 0)
@@ -782,6 +1096,66 @@ class _IMDbNamesParser(_IMDbParser):
             datalist.sort(key=lambda x: 9999 if x[2] is None else x[2])
         return data
 
+    def filmography(self, names):
+        """Return a dictionary that contains the credits of each of names
+        (people, named as in the data file), as lists of (title, character,
+        order, notes), in order of the data file. The credits of each person
+        are found with the name index (nameindexfile), by seeking to each
+        place the person is listed; without it, the whole file is read."""
+        names = set(names)
+        credits = defaultdict(list)
+        if not names:
+            return credits
+        if not self.dbfile:
+            raise NotImplementedError('%s must be converted (with '
+                                      'rebuild_index) to be searched' %
+                                      self.listname)
+        indexed = bool(self.nameindexfile and
+                       os.path.exists(self.nameindexfile))
+        if indexed:
+            index = TitleIndex(self.nameindexfile)
+            locs = sorted(set(loc for name in names
+                              for loc in index.lookup(name.encode('utf-8'))))
+            index.close()
+        else:
+            locs = [0]
+        if self.debug:
+            print "Reading %s..." % self.listname
+        timer = Timer()
+        fileobj = ChunkedFile(self.dbfile, self.listname, mode='r',
+                              readahead=0 if indexed else READAHEAD,
+                              cache=indexed)
+        try:
+            for loc in locs:
+                fileobj.seek(loc)
+                self.last_person = (None, None)
+                for i, (lineloc, line) in \
+                        enumerate(fileobj.iter_lines_with_offsets()):
+                    line = line.rstrip().decode('iso-8859-1')
+                    if i % 100 == 0:
+                        timer.step()
+                    if indexed and not line:
+                        break       # End of this person's credits
+                    data = self._parse_line(line, lineloc)
+                    if data is None and indexed:
+                        break       # End of database
+                    elif data is None:
+                        # End of one of the data files (see filenames)
+                        self.last_person = (None, None)
+                        continue
+                    if not data:
+                        continue    # Skip this line
+                    title, _, (name, character, order, notes) = data
+                    if name in names:
+                        credits[name].append((title, character, order, notes))
+                    elif indexed:
+                        break       # Not a person of names
+        finally:
+            fileobj.close()
+        if self.debug:
+            print 'Completed in', timer, 'seconds.'
+        return credits
+
 class IMDbCastParser(_IMDbNamesParser):
     """Parser for IMDb data files actors, actresses."""
     filenames = ['actors', 'actresses']
@@ -797,3 +1171,30 @@ class IMDbWritersParser(_IMDbNamesParser):
     filenames = ['writers']
     is_property = True
 
+def create_columns(dbfile, dbdir, debug=False):
+    """Write the column store of the database (dbfile.columns), giving each
+    title of movies.list in dbdir an ID, and storing the year of every
+    title and its search results for each parser with columns (see
+    _IMDbParser.columns)."""
+    titles = [title for title, in
+              IMDbMoviesParser(dbfile=None, dbdir=dbdir).search()]
+    store = columnstore.ColumnStore(dbfile + '.columns', mode='w',
+                                    titles=[title.encode('utf-8')
+                                            for title in titles])
+    years = {}
+    for title in titles:
+        year = parse_title(title).year
+        if year:
+            years[title.encode('utf-8')] = int(year, 10)
+    store.add('year', 'i', years)
+    for parsername, parser in parsers():
+        if not parser.columns:
+            continue
+        obj = parser(dbfile=dbfile, debug=debug)
+        values = [{} for _ in obj.columns]
+        for title, result in obj.search().iteritems():
+            for i, value in enumerate(obj._to_columns(result)):
+                values[i][title.encode('utf-8')] = value
+        for (name, typecode), column in izip(obj.columns, values):
+            store.add(name, typecode, column)
+    store.close()
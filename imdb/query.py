@@ -0,0 +1,166 @@
+"""query - Filter and sort the titles of the column store by scanning its
+columns."""
+
+import heapq
+from itertools import compress, imap
+
+# Fields that titles can be filtered and sorted by, and the column storing
+# each (see parsers.create_columns)
+FIELDS = {
+    'year': 'year',
+    'votes': 'rating_nratings',
+    'score': 'rating_score',
+    'running_time': 'running_time',
+    'genre': 'genres',
+    'certificate': 'certificate',
+}
+
+def _as_range(value):
+    """Return value, a (min, max) pair (either of which may be None) or a
+    single value, as a pair."""
+    if isinstance(value, (tuple, list)):
+        low, high = value
+        return low, high
+    return value, value
+
+def _as_set(value):
+    """Return value, a string or a list of strings, as a set."""
+    if isinstance(value, basestring):
+        return set((value,))
+    return set(value)
+
+def _in_range(low, high, missing=None):
+    """Return a function testing whether a value (or missing, for no value)
+    is between low and high, inclusive (either may be None)."""
+    def in_range(value):
+        """Return whether value is in the range."""
+        return value != missing and (low is None or value >= low) and \
+            (high is None or value <= high)
+    return in_range
+
+def _score(string):
+    """Return the score (a string, or None) as a float."""
+    return float(string) if string is not None else None
+
+class _Columns(object):
+    """The values of the fields of each title of a ColumnStore, by title
+    ID, as arrays (or, for strings, arrays of the codes of a dictionary of
+    values; see ColumnStore.strings)."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def codes(self, field, test):
+        """Return the set of the codes of the values of field (a string
+        column) for which test is true."""
+        values = self.store.strings(FIELDS[field])
+        if field == 'score':
+            values = [_score(value) for value in values]
+        elif field == 'genre':
+            # Genres are separated by tabs (see IMDbGenresParser)
+            values = [set(value.split('\t')) if value else set()
+                      for value in values]
+        return set(code for code, value in enumerate(values)
+                   if code and test(value))
+
+    def key(self, field):
+        """Return a function returning the value of field for a title ID
+        (None for no value), for sorting."""
+        if field == 'title':
+            return self.store.title
+        column = self.store.column(FIELDS[field])
+        if field == 'score':
+            scores = [_score(value)
+                      for value in self.store.strings('rating_score')]
+            return lambda titleid: scores[column[titleid]]
+        elif field in ('genre', 'certificate'):
+            strings = self.store.strings(FIELDS[field])
+            return lambda titleid: strings[column[titleid]]
+        missing = self.store.missing(FIELDS[field])
+        return lambda titleid: column[titleid] \
+            if column[titleid] != missing else None
+
+def _filters(columns, filters):
+    """Return the list of filters to apply, as (field, column, codes, test),
+    where codes is the set of the codes of a string column that match the
+    filter, or test is a function testing the values of a numeric column.
+    Filters on string columns come first, since they are faster."""
+    coded = []
+    numeric = []
+    for field, value in sorted(filters.items()):
+        if value is None:
+            continue
+        if field not in FIELDS:
+            raise ValueError('Unknown field %s' % field)
+        column = columns.store.column(FIELDS[field])
+        if field == 'genre':
+            genres = _as_set(value)
+            coded.append((field, column, columns.codes(
+                field, lambda value: genres <= value), None))
+        elif field == 'certificate':
+            certificates = _as_set(value)
+            coded.append((field, column, columns.codes(
+                field, lambda value: value in certificates), None))
+        elif field == 'score':
+            coded.append((field, column,
+                          columns.codes(field, _in_range(*_as_range(value))),
+                          None))
+        else:
+            low, high = _as_range(value)
+            numeric.append((field, column, None, _in_range(
+                low, high, columns.store.missing(FIELDS[field]))))
+    return coded + numeric
+
+def query(store, filters, sort=None, limit=None):
+    """Return the list of the IDs of the titles of store (a ColumnStore)
+    matching filters, a dictionary of the values of fields (see FIELDS) to
+    match. Each filter is a scan of its column, testing one value at a
+    time: the first filter tests the value of every title, the next only
+    those of the titles matching the first, etc.
+
+    year, votes, score and running_time match a range of values, as a pair
+    (min, max) (inclusive; either may be None) or a single value. genre
+    matches titles with a genre, or with all of a list of genres;
+    certificate matches titles with a certificate, or with any of a list.
+
+    Titles are returned in order of title, or sorted by sort, the name of a
+    field or 'title', prefixed with '-' for descending order; titles without
+    a value come last. If limit is given, at most that many titles are
+    returned."""
+    columns = _Columns(store)
+    titleids = None
+    for field, column, codes, test in _filters(columns, filters):
+        if titleids is None:
+            # Test the values of the whole column
+            if codes is not None:
+                matches = imap(codes.__contains__, column)
+            else:
+                matches = imap(test, column)
+            titleids = list(compress(xrange(store.ntitles), matches))
+        elif codes is not None:
+            titleids = [titleid for titleid in titleids
+                        if column[titleid] in codes]
+        else:
+            titleids = [titleid for titleid in titleids
+                        if test(column[titleid])]
+    if titleids is None:
+        titleids = range(store.ntitles)
+    if sort:
+        reverse = sort.startswith('-')
+        field = sort.lstrip('-')
+        if field != 'title' and field not in FIELDS:
+            raise ValueError('Unknown field %s' % field)
+        key = columns.key(field)
+        keys = [(key(titleid), titleid) for titleid in titleids]
+        # Titles without a value last, in order of title
+        valued = [item for item in keys if item[0] is not None]
+        unvalued = [titleid for value, titleid in keys if value is None]
+        if limit is not None and limit < len(valued):
+            select = heapq.nlargest if reverse else heapq.nsmallest
+            valued = select(limit, valued, key=lambda item: item[0])
+        else:
+            valued.sort(key=lambda item: item[0], reverse=reverse)
+        titleids = [titleid for _, titleid in valued] + unvalued
+    if limit is not None:
+        titleids = titleids[:limit]
+    return titleids
@@ -1,17 +1,21 @@
 """search - Search capability for movie list."""
 
-from difflib import SequenceMatcher
-from collections import Counter
+from collections import defaultdict
+import heapq
 import re
 
 from chunkedfile import ChunkedFile
-from utils import Timer, open_compressed
+from ngramindex import NgramIndex, candidates
+import similarity
+from utils import Timer, get_pool, open_compressed, resident_memory, \
+    wait_result
 import parsers
 from datetime import date
 from math import exp
 
+from cStringIO import StringIO
 import os.path
-from subprocess import Popen, PIPE, STDOUT
+from tempfile import TemporaryFile
 
 # Helper functions for search
 
@@ -59,16 +63,47 @@ def _clean_words(words, strip_stems=True):
         limited.append(word)
     return limited if limited else normed
 
+def _title_variants(title):
+    """Return the forms of title that are compared to search queries: the
+    lower-cased title, the lower-cased name (without IMDb suffixes), and
+    the name without its subtitle (after ':'), or '' if it has none."""
+    lctitle = title.lower()
+    lcname = parsers.TITLERE.match(title).group('name').lower()
+    lcshort = lcname[0:lcname.find(':')] if ':' in lcname else ''
+    return lctitle, lcname, lcshort
+
 # Search implementation
-def create_index(dbfile, dbdir, debug=False):
-    """Index the movie list for searching."""
+def _ngram_files(dbfile):
+    """Return the filenames of the n-gram index of dbfile: either
+    dbfile.ngrams, or shards dbfile.ngrams.0, dbfile.ngrams.1, etc.
+    Returns an empty list if there is no n-gram index."""
+    if os.path.exists(dbfile + '.ngrams'):
+        return [dbfile + '.ngrams']
+    filenames = []
+    while os.path.exists('%s.ngrams.%d' % (dbfile, len(filenames))):
+        filenames.append('%s.ngrams.%d' % (dbfile, len(filenames)))
+    return filenames
+
+def create_index(dbfile, dbdir, size=5, shards=1, debug=False):
+    """Index the movie list for searching. In addition to the compressed
+    search index (dbfile.idx), write an n-gram index (dbfile.ngrams) of
+    subwords of length size so searches need not scan every title.
+    If shards is greater than one, the n-gram index is split into that many
+    files (dbfile.ngrams.0, etc.) that are searched in parallel.
+    Titles are ordered by year (titles without a year first), and the
+    n-gram index is partitioned by year, so searches with a year need only
+    read titles from nearby years."""
     # Load ratings; number of ratings included in index for score weighting
     ratings = parsers.IMDbRatingParser(dbfile=dbfile, debug=debug).search()
 
-    # Count word frequencies while outputting searchable list
-    frequencies = Counter()
+    # Output searchable list. (The number of titles containing each n-gram,
+    # used to prefer rare n-grams when searching, is the length of its
+    # posting list in the n-gram index.)
     #indexfh = ChunkedFile(dbfile, 'index', mode='a')
     indexfh = open_compressed(dbfile+'.idx', mode='w')
+    # Titles of each year (0 for unknown), to be copied into the indexes
+    # in order of year
+    years = {}
 
     # Index all IMDb titles
     skipped = 0
@@ -92,170 +127,517 @@ def create_index(dbfile, dbdir, debug=False):
                     continue
                 last_time = obj
             searchable = _clean_word(data.name).split(' ')
-            # Save word frequencies
-            frequencies.update(searchable)
             # Determine rating for result ranking
             nratings = 0
             if akafor and akafor in ratings:
                 nratings = ratings[akafor].nratings
             elif not akafor and data.title in ratings:
                 nratings = ratings[data.title].nratings
-            # Write movie to output
-            indexfh.write("\t".join((''.join(searchable),
-                                     data.year.encode('ascii')
-                                     if data.year else '',
-                                     data.title.encode('utf-8'),
-                                     akafor.encode('utf-8'),
-                                     str(nratings))))
-            indexfh.write("\n")
+            # Write movie to output, with the forms of the title used for
+            # ranking (see _title_variants)
+            line = "\t".join((''.join(searchable),
+                              data.year.encode('ascii')
+                              if data.year else '',
+                              data.title.encode('utf-8'),
+                              akafor.encode('utf-8'),
+                              str(nratings)) +
+                             tuple(variant.encode('utf-8') for variant in
+                                   _title_variants(data.title))) + "\n"
+            year = int(data.year) if data.year else 0
+            if year not in years:
+                years[year] = TemporaryFile()
+            years[year].write(line)
+
+    for year in sorted(years):
+        yearfh = years[year]
+        yearfh.seek(0)
+        for line in yearfh:
+            indexfh.write(line)
+        yearfh.close()
     indexfh.close()
     #print "Skipped %d duplicate AKA titles" % skipped
+    write_ngrams(dbfile, size=size, shards=shards)
+
+def write_ngrams(dbfile, size=5, shards=1, idxfile=None):
+    """Write the n-gram index of dbfile (see create_index) from its search
+    index, or from idxfile, the search index of another database (such as
+    to index it with a different number of shards)."""
+    for filename in _ngram_files(dbfile):
+        os.remove(filename)
+    if shards > 1:
+        ngramfhs = [NgramIndex('%s.ngrams.%d' % (dbfile, i), mode='w',
+                               size=size) for i in xrange(shards)]
+    else:
+        ngramfhs = [NgramIndex(dbfile+'.ngrams', mode='w', size=size)]
+    indexfh = open_compressed(idxfile or dbfile+'.idx')
+    for nrows, line in enumerate(indexfh):
+        searchable, year, _ = line.split('\t', 2)
+        # Distribute titles evenly among the shards
+        ngramfhs[nrows % len(ngramfhs)].add(searchable, line,
+                                            partition=int(year or 0))
+    indexfh.close()
+    for ngramfh in ngramfhs:
+        ngramfh.close()
+
+# Minimum number of candidate titles to read from the n-gram index for
+# each query (see NgramIndex.candidates); 0 to use every n-gram.
+MIN_CANDIDATES = 1000
+
+def _query_words(queries, size, strip_stems=True, deltayear=8):
+    """Return, for each of queries (see _search_index), the subwords
+    expected in the SEARCHABLE field of matching titles, the subwords of
+    each of its words, and the range of acceptable years (or None)."""
+    wordlists = []
+    gramlists = []
+    validyears = []
+    for words, year in queries:
+        words = _clean_words(words, strip_stems)
+        wordlists.append(tuple(_subwords(words, size)))
+        gramlists.append([tuple(_subwords((word,), size)) for word in words])
+        validyears.append((year-deltayear, year+deltayear) if year else None)
+    return wordlists, gramlists, validyears
+
+def _candidate_rows(ngramfhs, gramlists, validyears, min_candidates):
+    """Return, for each of ngramfhs (the shards of an n-gram index), a
+    dictionary mapping the row number of each candidate title to the
+    positions in gramlists of the queries it may match (see _query_words
+    and ngramindex.candidates)."""
+    shardrows = [defaultdict(list) for _ in ngramfhs]
+    for qidx, gramlist in enumerate(gramlists):
+        # Only read titles from the years near the query's year, and
+        # titles without a year
+        shards = []
+        for ngramfh in ngramfhs:
+            rows = None
+            if validyears[qidx]:
+                rows = [ngramfh.partition_rows(0, 0),
+                        ngramfh.partition_rows(*validyears[qidx])]
+            shards.append((ngramfh, rows))
+        for rowqueries, rowids in zip(shardrows, candidates(
+                shards, gramlist, min_candidates)):
+            for rowid in rowids:
+                rowqueries[rowid].append(qidx)
+    return shardrows
+
+def _open_ngrams(ngramfile, in_memory, debug=False):
+    """Open the n-gram index ngramfile (or load it into memory, see
+    _load_resident)."""
+    if in_memory:
+        return _load_resident(ngramfile, debug=debug)
+    return NgramIndex(ngramfile)
+
+def _search_index(timer, dbfile, queries, size, strip_stems=True,
+                  deltayear=8, debug=False, ngramfile=None, in_memory=False,
+                  min_candidates=None, rowqueries=None):
+    """Yield a subset of the database that somewhat matches any of queries,
+    in a single pass over the index. Returns any movies that contains a
+    subword of any of the words of a query. (See the _subwords function.)
+    Shorter subwords means more results, but slower performance.
+    Yields (matches, (title, year, akafor, nratings, lctitle, lcname,
+    lcshort)), where matches lists the positions in queries of the queries
+    that the movie matched. year (or None) and nratings are integers; see
+    _title_variants for the remaining fields.
 
-    # Write frequencies to stopwords file
-    if False:
-        swf = ChunkedFile(dbfile, 'stopwords', mode='a')
-        for word, numtimes in frequencies.most_common():
-            swf.write("%s %d\n" % (word, numtimes))
-        swf.close()
-
-def _search_index(timer, dbfile, words, size, strip_stems=True,
-                  year=None, deltayear=8, debug=False):
-    """Yield a subset of the database that somewhat matches words.
-    Returns any movies that contains a subword of any of words.
-    (See the _subwords function.) Shorter subwords means more results, but
-    slower performance.
-
-    words -- List of words.
+    queries -- List of (words, year) pairs. words is a list of words; year
+               is a guess of the year (or None). Only returns movies dated
+               near year for that query.
     size -- Length of subwords to use for search. (See _subwords function.)
     strip_stems -- Omit really common subwords. (See _subwords function.)
-    year -- A guess of the year. Only returns movies dated near year.
     deltayear -- Only return movies with year [year-deltayear,year+deltayear].
+    ngramfile -- n-gram index to search (default dbfile.ngrams, if present).
+    in_memory -- Keep the search index in memory for later searches.
+    min_candidates -- With an n-gram index, only use the rarest subwords
+                      needed to find this many titles for each query
+                      (default MIN_CANDIDATES).
+    rowqueries -- The candidate titles of ngramfile, if already chosen (as
+                  from _candidate_rows).
     """
     # Extract a plausible-looking subset of the database so we don't
-    # have to run SequenceMatcher on everything. This works pretty
+    # have to compare the query to everything. This works pretty
     # well, except for movies like O (2001).
 
-    # A list of plain-text strings that we expect to find in the
-    # SEARCHABLE field of the data. We will require at least one of
-    # these to be present.
-    wordlist = tuple(_subwords(_clean_words(words, strip_stems), size))
-    # If we are provided with an estimated year, compose a list of
-    # acceptable years.
-    validyears = range(year-deltayear, year+deltayear) if year else ()
+    # For each query: a list of plain-text strings that we expect to
+    # find in the SEARCHABLE field of the data. We will require at least
+    # one of these to be present. If we are provided with an estimated
+    # year, also compose the range of acceptable years.
+    wordlists, gramlists, validyears = _query_words(queries, size,
+                                                    strip_stems, deltayear)
     if debug:
-        print wordlist
+        for wordlist in wordlists:
+            print wordlist
         print "Searching..."
 
-    # Reading lines out of a GzipFile is very slow; using gzip(1) is ~6.5x
-    # faster. For further speedup, we could use zgrep(1) to extract our
-    # subset using grep(1).
-    #indexfh = ChunkedFile(dbfile, 'index')
-    if os.path.exists(dbfile + '.idx.use-zgrep'):
-        indexfh = Popen(('zgrep', '-F', '\n'.join(wordlist), dbfile+'.idx'),
-                                   stdout=PIPE, stderr=STDOUT).stdout
-    else:
-        indexfh = open_compressed(dbfile+'.idx')
-    #indexfh = open('idx.tmp')
-
-    for i, line in enumerate(indexfh):
-        # Quick check to determine if the entry matches any of our words
-        # (grep -F is faster; grep -E might be faster still)
-        for word in wordlist:
-            if word in line:
-                break
+    # If available, use the n-gram index to read only the lines that
+    # contain one of our words, instead of scanning the entire index.
+    indexfh = None
+    ngramfh = None
+    scanfh = None
+    if ngramfile is None and os.path.exists(dbfile + '.ngrams'):
+        ngramfile = dbfile + '.ngrams'
+    if ngramfile:
+        ngramfh = _open_ngrams(ngramfile, in_memory, debug=debug)
+        if min_candidates is None:
+            min_candidates = MIN_CANDIDATES
+        if ngramfh.size == size:
+            if rowqueries is None:
+                rowqueries = _candidate_rows([ngramfh], gramlists,
+                                             validyears, min_candidates)[0]
+            indexfh = ((rowqueries[rowid], ngramfh.row(rowid))
+                       for rowid in sorted(rowqueries))
+    if indexfh is None:
+        # Otherwise, scan the entire compressed index. Reading lines out
+        # of a GzipFile is very slow; using gzip(1) is ~6.5x faster.
+        if in_memory:
+            scanfh = StringIO(_load_resident(dbfile+'.idx', debug=debug))
         else:
-            continue
+            scanfh = open_compressed(dbfile+'.idx')
+        indexfh = _scan_index(timer, scanfh, wordlists)
 
-        # Get SEARCHABLE\tYEAR\tTITLE
-        ryear, title, akafor, nratings = line.decode('utf-8').split('\t')[1:]
+    for i, (matches, line) in enumerate(indexfh):
+        # Get SEARCHABLE\tYEAR\tTITLE\tAKAFOR\tNRATINGS, followed by the
+        # variants of TITLE (except in indexes built by older versions)
+        fields = line.decode('utf-8').rstrip('\n').split('\t')
 
         # Check that the year is within tolerances
-        if validyears and ryear and int(ryear) not in validyears:
-            continue
+        ryear = int(fields[1]) if fields[1] else None
+        if ryear:
+            matches = [qidx for qidx in matches if not validyears[qidx]
+                       or validyears[qidx][0] <= ryear <= validyears[qidx][1]]
+            if not matches:
+                continue
 
-        yield title, ryear, akafor, nratings
+        title = fields[2]
+        variants = fields[5:8] if len(fields) > 5 \
+            else _title_variants(title)
+        yield matches, (title, ryear, fields[3], int(fields[4])) + \
+            tuple(variants)
         if i % 100 == 0:
             timer.step()
-    indexfh.close()
+    if scanfh:
+        scanfh.close()
+    if ngramfh and not in_memory:
+        ngramfh.close()
     if debug:
         print 'Completed search in', timer, 'seconds.'
 
-def search(dbfile, query, year=None, size=5, debug=False, timeout=None):
-    """Search the database for query, optionally with an estimated year."""
-    this_year = date.today().year
-    if year:
-        year = int(year)
-    words = query.split()
-    timer = Timer(timeout=timeout)
-    results = _search_index(timer, dbfile, words, size, year=year, debug=debug)
+def _scan_index(timer, fileobj, wordlists, blocksize=1048576):
+    """Yield (matches, line) for each line of fileobj (a search index)
+    that contains any of the words in wordlists (a list of lists of words),
+    where matches lists the positions in wordlists of the lists with a word
+    in the line. Rather than testing each word against each line, the file
+    is read in large blocks, and each word is located in the whole block
+    with a fast substring search. (A single regular expression of all the
+    words is slower than either.) Only the first (SEARCHABLE) field of each
+    line is matched, as in the n-gram index."""
+    wordqueries = defaultdict(list)
+    for qidx, wordlist in enumerate(wordlists):
+        for word in set(wordlist):
+            wordqueries[word].append(qidx)
+    if not wordqueries:
+        return
+    remainder = ''
+    while True:
+        data = fileobj.read(blocksize)
+        block = remainder + data
+        if not block:
+            break
+        # Search only complete lines; keep the rest for the next block.
+        end = block.rfind('\n') + 1 if data else len(block)
+        block, remainder = block[:end], block[end:]
+        timer.step()
+
+        # Find the start of each line containing a word in its first
+        # field, and the queries that the line matches
+        lines = defaultdict(list)
+        for word, qidxs in wordqueries.iteritems():
+            pos = block.find(word)
+            while pos >= 0:
+                start = block.rfind('\n', 0, pos) + 1
+                # The first occurrence in the line is the earliest, so the
+                # first field contains the word only if it contains this one
+                tab = block.find('\t', start, pos)
+                if tab < 0:
+                    lines[start].extend(qidxs)
+                # Skip to the next line
+                end = block.find('\n', pos) + 1 or len(block)
+                pos = block.find(word, end)
+        for start in sorted(lines):
+            end = block.find('\n', start) + 1 or len(block)
+            yield sorted(set(lines[start])), block[start:end]
+
+# Search index files loaded into memory, by filename: (mtime, contents)
+_RESIDENT = {}
+
+def _load_resident(filename, debug=False):
+    """Return the in-memory copy of a search index file, loading it (or
+    reloading it, if the file has changed) if necessary. Returns an
+    NgramIndex for n-gram indexes, and the decompressed contents of the
+    compressed search index."""
+    mtime = os.path.getmtime(filename)
+    if filename in _RESIDENT and _RESIDENT[filename][0] == mtime:
+        return _RESIDENT[filename][1]
+    _RESIDENT.pop(filename, None)
+    before = resident_memory()
+    if filename.endswith('.idx'):
+        fileobj = open_compressed(filename)
+        contents = fileobj.read()
+        fileobj.close()
+    else:
+        contents = NgramIndex(filename, memory=True)
+    _RESIDENT[filename] = (mtime, contents)
+    if debug:
+        after = resident_memory()
+        print 'Loaded %s into memory (%d KiB; resident size grew %s KiB)' % \
+            (filename, _resident_size(contents)/1024,
+             (after-before)/1024 if before and after else 'unknown')
+    return contents
+
+def _resident_size(contents):
+    """Return the size in bytes of a search index file loaded in memory."""
+    return len(contents.data if isinstance(contents, NgramIndex)
+               else contents)
+
+def resident_size(dbfile):
+    """Return the number of bytes of dbfile's search index held in memory
+    by this process (see search_many). Shards loaded by worker processes
+    are not included."""
+    return sum(_resident_size(contents)
+               for filename, (_, contents) in _RESIDENT.items()
+               if filename.startswith(dbfile + '.'))
+
+class _Scorer(object):
+    """Rank entries of the search index by similarity to a single query,
+    keeping only the limit best-scoring titles."""
 
     # Similar to diffutils.get_close_matches, but ignores capitalization
     # and IMDb suffixes.
-    scores = {}
-    akascores = {}
     cutoff = 0.6
-    lcquery = query.lower()
-    matchers = [(1.0, SequenceMatcher(b=lcquery))]
-    if year:
-        yearstr = ' ('+str(year)
-        if yearstr not in lcquery:
-            matchers.append((1.0, SequenceMatcher(b=lcquery+yearstr+')')))
-
-    for title, ryear, akafor, nratings in results:
-        titles = [(1.0, title.lower()),
-                  (1.0, parsers.TITLERE.match(title).group('name').lower())]
+
+    def __init__(self, query, year=None, limit=30, backend=None):
+        """Prepare to score entries against query, optionally with an
+        estimated year. backend is the similarity measure to use (see
+        similarity.get_backend)."""
+        self.this_year = date.today().year
+        self.year = year
+        self.limit = limit
+        self.scores = {}
+        self.akascores = {}
+        # Min-heap of (score, title) for the titles in scores. Entries are
+        # not removed when a title's score improves, so some are stale.
+        self._heap = []
+        backend = similarity.get_backend(backend)
+        lcquery = query.lower()
+        self.matchers = [(1.0, backend(lcquery))]
+        if year:
+            yearstr = ' ('+str(year)
+            if yearstr not in lcquery:
+                self.matchers.append((1.0, backend(lcquery+yearstr+')')))
+
+    def _is_stale(self, entry):
+        """Determine if a heap entry no longer reflects scores."""
+        return self.scores.get(entry[1]) != entry[0]
+
+    def threshold(self):
+        """Return the score that a title must exceed to be kept, i.e. the
+        lowest score of the current results, once there are limit of them."""
+        if len(self.scores) < self.limit:
+            return 0
+        heap = self._heap
+        while self._is_stale(heap[0]):
+            heapq.heappop(heap)
+        return heap[0][0]
+
+    def _record(self, stored_title, score, aka):
+        """Record score for stored_title (matched by alternate name aka),
+        if it is among the best scores. Titles with equal scores are ranked
+        by title, so that the results do not depend on the order in which
+        titles are recorded."""
+        scores = self.scores
+        if stored_title in scores:
+            if scores[stored_title] >= score:
+                return
+        elif len(scores) >= self.limit:
+            self.threshold()
+            if (score, stored_title) <= self._heap[0]:
+                return
+            # Evict the lowest-scoring title (threshold removed any stale
+            # entries from the top of the heap)
+            _, evicted = heapq.heappop(self._heap)
+            del scores[evicted]
+            self.akascores.pop(evicted, None)
+        scores[stored_title] = score
+        if aka:
+            self.akascores[stored_title] = aka
+        else:
+            self.akascores.pop(stored_title, None)
+        heapq.heappush(self._heap, (score, stored_title))
+        if len(self._heap) > 2*self.limit:
+            self._heap = [entry for entry in self._heap
+                          if not self._is_stale(entry)]
+            heapq.heapify(self._heap)
+
+    @staticmethod
+    def _could_match(ratio, cutoff, factor, threshold):
+        """Determine if ratio (or an upper bound on it) exceeds cutoff, and
+        would give a score (with weight factor) of at least threshold."""
+        return ratio > cutoff and ratio*factor >= threshold
+
+    def add(self, title, ryear, akafor, nratings, lctitle, lcname, lcshort):
+        """Score an entry of the search index (as from _search_index), and
+        record it if it is among the best matches. Returns the score (zero
+        if the entry did not match, or could not have scored highly enough
+        to be recorded)."""
+        year = self.year
+        stored_title = akafor if akafor else title
+        # Weight score by the number of ratings
+        factor = (0.0205376)*nratings**(0.167496)+(0.9226)
+        # Slightly discourage TV shows in favor of movies. This
+        # makes it more difficult to match mini-series, but that's
+        # just too bad.
+        if stored_title[0] == '"':
+            factor *= 0.95
+        # Movies without a known year are extremely unlikely to be the
+        # correct result.
+        if not ryear:
+            factor *= 0.90
+        elif year: # and ryear
+            if year == self.this_year and ryear == self.this_year:
+                # Extend the benefit of the doubt to prerelease movies
+                # (and others from this year) that have not had many
+                # votes on IMDb.
+                factor = max(factor, 1)
+            # Adjust weight to disambiguate results by year-similarity
+            factor *= exp(-(year-ryear)**2/160.0)
+
+        # The similarity ratio is at most 1, so the final score is at most
+        # factor. Skip entries that cannot reach the current results, and
+        # otherwise only accept ratios that could (_record decides ties).
+        threshold = self.threshold()
+        if factor < threshold:
+            return 0
+        mycutoff = self.cutoff
+
+        titles = [(1.0, lctitle), (1.0, lcname)]
         # Try matching without the subtitle. But only do this if the query
         # included a year, since otherwise "ABC (1991)" and "ABC: Revenge
         # of the DEF (1999)" rank the same. We exact a 95% penalty against
         # matches that occur this way.
-        if year and ':' in titles[-1][1]:
-            titles.append((0.95, titles[-1][1][0:titles[-1][1].find(':')]))
+        if year and lcshort:
+            titles.append((0.95, lcshort))
         # Take highest score from all matches checked
         score = 0
-        mycutoff = cutoff
         # Match against query with and without year
-        for matcherpenalty, matcher in matchers:
-            # Check titile both with and without the suffix
-            for titlepenalty, mystr in titles:
-                matcher.set_seq1(mystr)
-                if matcher.real_quick_ratio() > mycutoff and \
-                    matcher.quick_ratio() > mycutoff:
-                    myratio = matcher.ratio()*matcherpenalty*titlepenalty
-                    if myratio > mycutoff:
-                        score = max(score, myratio)
-                        mycutoff = score
+        for matcherpenalty, matcher in self.matchers:
+            # Check titile both with and without the suffix, computing the
+            # ratios of those that could match in one batch
+            checked = [(titlepenalty, mystr) for titlepenalty, mystr in titles
+                       if self._could_match(matcher.real_quick_ratio(mystr),
+                                            mycutoff, factor, threshold) and
+                       self._could_match(matcher.quick_ratio(mystr),
+                                         mycutoff, factor, threshold)]
+            if not checked:
+                continue
+            ratios = matcher.ratios([mystr for _, mystr in checked])
+            for (titlepenalty, _), myratio in zip(checked, ratios):
+                myratio *= matcherpenalty*titlepenalty
+                if self._could_match(myratio, mycutoff, factor, threshold):
+                    score = max(score, myratio)
+                    mycutoff = score
 
         # If the movie scored at all, add it to the result list
         if score > 0:
-            timer.check_expired()
-            nratings = int(nratings)
-            stored_title = akafor if akafor else title
-            # Weight score by the number of ratings
-            factor = (0.0205376)*nratings**(0.167496)+(0.9226)
-            # Slightly discourage TV shows in favor of movies. This
-            # makes it more difficult to match mini-series, but that's
-            # just too bad.
-            if stored_title[0] == '"':
-                factor *= 0.95
-            # Movies without a known year are extremely unlikely to be the
-            # correct result.
-            if not ryear:
-                factor *= 0.90
-            elif year: # and ryear
-                ryear = int(ryear)
-                if year == this_year and ryear == this_year:
-                    # Extend the benefit of the doubt to prerelease movies
-                    # (and others from this year) that have not had many
-                    # votes on IMDb.
-                    factor = max(factor, 1)
-                # Adjust weight to disambiguate results by year-similarity
-                factor *= exp(-(year-ryear)**2/160.0)
             score *= factor
-            if stored_title not in scores or scores[stored_title] < score:
-                scores[stored_title] = score
-                if akafor:
-                    akascores[stored_title] = title
-                elif stored_title in akascores:
-                    del akascores[stored_title]
-    return scores, akascores
+            self._record(stored_title, score, title if akafor else None)
+        return score
+
+def search(dbfile, query, year=None, size=5, limit=30, debug=False,
+           timeout=None, backend=None, in_memory=False):
+    """Search the database for query, optionally with an estimated year.
+    Returns a tuple (scores, akascores) of dictionaries, mapping the limit
+    best-scoring titles to their score and, for titles matched by an
+    alternate name, to that name. backend selects the string similarity
+    measure used for ranking (see similarity.get_backend)."""
+    return search_many(dbfile, ((query, year),), size=size, limit=limit,
+                       debug=debug, timeout=timeout, backend=backend,
+                       in_memory=in_memory)[0]
+
+def search_many(dbfile, queries, size=5, limit=30, debug=False,
+                timeout=None, backend=None, in_memory=False):
+    """Search the database for each of queries, a list of (query, year)
+    pairs (year may be None), reading the search index only once.
+    Returns a list of (scores, akascores) tuples, as from search, in the
+    same order as queries. If the n-gram index is sharded, the shards are
+    searched in parallel by a pool of worker processes.
+    If in_memory=True, the search index is loaded into memory on first use
+    (by each process) and kept there for later searches, instead of being
+    read from disk for every search."""
+    queries = [(query, int(year) if year else None)
+               for query, year in queries]
+    shards = _ngram_files(dbfile)
+    if len(shards) <= 1:
+        return _search_many(dbfile, queries, size, limit, debug, timeout,
+                            backend, in_memory)
+
+    # Choose the candidate titles of every shard together, so that the
+    # results do not depend on the number of shards, then search each shard
+    # in a worker process and merge the results. Each worker enforces the
+    # timeout, stopping its search if it is exceeded.
+    timer = Timer(timeout=timeout)
+    shardrows = _shard_candidates(queries, shards, size, in_memory, debug)
+    tasks = [(dbfile, queries, size, limit, debug, timeout, backend,
+              in_memory, shard, rowqueries)
+             for shard, rowqueries in zip(shards, shardrows)]
+    shardresults = wait_result(get_pool().map_async(_search_shard, tasks),
+                               timer)
+    merged = []
+    for qidx, (query, year) in enumerate(queries):
+        scorer = _Scorer(query, year, limit=limit, backend=backend)
+        for results in shardresults:
+            scores, akascores = results[qidx]
+            for title, score in scores.iteritems():
+                scorer._record(title, score, akascores.get(title))
+        merged.append((scorer.scores, scorer.akascores))
+    timer.check_expired()
+    return merged
+
+def _shard_candidates(queries, shards, size, in_memory, debug=False):
+    """Return the candidate titles of each of shards (n-gram index files)
+    for queries (see search_many), as from _candidate_rows, or Nones if the
+    shards do not have subwords of length size."""
+    ngramfhs = [_open_ngrams(shard, in_memory, debug=debug)
+                for shard in shards]
+    try:
+        if any(ngramfh.size != size for ngramfh in ngramfhs):
+            return [None] * len(shards)
+        wordlists, gramlists, validyears = _query_words(
+            [(query.split(), year) for query, year in queries], size)
+        return _candidate_rows(ngramfhs, gramlists, validyears,
+                               MIN_CANDIDATES)
+    finally:
+        if not in_memory:
+            for ngramfh in ngramfhs:
+                ngramfh.close()
+
+def _search_many(dbfile, queries, size, limit, debug, timeout, backend,
+                 in_memory, ngramfile=None, rowqueries=None):
+    """Search the database (or a single n-gram index shard) for queries.
+    See search_many."""
+    scorers = []
+    indexqueries = []
+    for query, year in queries:
+        scorers.append(_Scorer(query, year, limit=limit, backend=backend))
+        indexqueries.append((query.split(), year))
+    timer = Timer(timeout=timeout)
+    results = _search_index(timer, dbfile, indexqueries, size, debug=debug,
+                            ngramfile=ngramfile, in_memory=in_memory,
+                            rowqueries=rowqueries)
+
+    for matches, entry in results:
+        for qidx in matches:
+            if scorers[qidx].add(*entry) > 0:
+                timer.check_expired()
+    return [(scorer.scores, scorer.akascores) for scorer in scorers]
 
+def _search_shard(args):
+    """Search a shard of the n-gram index (in a worker process)."""
+    return _search_many(*args)
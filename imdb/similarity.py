@@ -0,0 +1,101 @@
+"""similarity - String similarity measures for ranking search results.
+
+Each backend is constructed with a fixed string b (the query) and compares
+it against many strings a (titles), with the same methods as
+difflib.SequenceMatcher: real_quick_ratio and quick_ratio return upper
+bounds on ratio, which returns the similarity in [0, 1].
+"""
+
+from difflib import SequenceMatcher
+
+def _real_quick_ratio(a, b):
+    """Return an upper bound on the ratio of a and b, from lengths alone."""
+    length = len(a) + len(b)
+    return 2.0*min(len(a), len(b))/length if length else 1.0
+
+class DifflibSimilarity(object):
+    """Similarity using difflib.SequenceMatcher (Ratcliff/Obershelp)."""
+
+    def __init__(self, b):
+        self.b = b
+        self.matcher = SequenceMatcher(b=b)
+
+    def real_quick_ratio(self, a):
+        """Return an upper bound on ratio(a), from lengths alone."""
+        return _real_quick_ratio(a, self.b)
+
+    def quick_ratio(self, a):
+        """Return an upper bound on ratio(a), from character counts."""
+        self.matcher.set_seq1(a)
+        return self.matcher.quick_ratio()
+
+    def ratio(self, a):
+        """Return the similarity of a to b."""
+        self.matcher.set_seq1(a)
+        return self.matcher.ratio()
+
+    def ratios(self, strings):
+        """Return a list of the similarity of each of strings to b."""
+        return [self.ratio(a) for a in strings]
+
+class LCSSimilarity(object):
+    """Similarity based on the longest common subsequence of a and b,
+    computed with a bit-parallel algorithm (one bit per character of b) in
+    O(len(a)) big-integer operations. The ratio is 2*LCS/(len(a)+len(b)),
+    which is never lower than the difflib ratio, since the blocks matched
+    by Ratcliff/Obershelp always form a common subsequence."""
+
+    def __init__(self, b):
+        self.b = b
+        self.mask = (1 << len(b)) - 1
+        # Bit j of masks[c] is set if b[j] == c
+        self.masks = {}
+        for j, char in enumerate(b):
+            self.masks[char] = self.masks.get(char, 0) | (1 << j)
+
+    def real_quick_ratio(self, a):
+        """Return an upper bound on ratio(a), from lengths alone."""
+        return _real_quick_ratio(a, self.b)
+
+    # Counting characters would cost about as much as computing the ratio.
+    quick_ratio = real_quick_ratio
+
+    def ratio(self, a):
+        """Return the similarity of a to b."""
+        return self.ratios((a,))[0]
+
+    def ratios(self, strings):
+        """Return a list of the similarity of each of strings to b."""
+        masks = self.masks
+        mask = self.mask
+        lenb = len(self.b)
+        ret = []
+        for a in strings:
+            # Bits of row are cleared at positions of b that are matched
+            # (Allison-Dix/Hyyro bit-vector LCS)
+            row = mask
+            for char in a:
+                matched = row & masks.get(char, 0)
+                row = ((row + matched) | (row - matched)) & mask
+            length = len(a) + lenb
+            lcs = lenb - bin(row).count('1')
+            ret.append(2.0*lcs/length if length else 1.0)
+        return ret
+
+# Available similarity backends, by name
+BACKENDS = {
+    'difflib': DifflibSimilarity,
+    'lcs': LCSSimilarity,
+}
+# LCS ratios are never lower than difflib's, which changes the ranking of
+# some results; difflib stays the default.
+DEFAULT = 'difflib'
+
+def get_backend(backend=None):
+    """Return a similarity class, given a class, the name of one of
+    BACKENDS, or None for the default backend."""
+    if backend is None:
+        backend = DEFAULT
+    if isinstance(backend, basestring):
+        return BACKENDS[backend]
+    return backend
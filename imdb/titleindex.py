@@ -0,0 +1,147 @@
+"""titleindex - Binary title-to-offsets index for the indexed data files.
+
+Also used to index the people of names data files, by name."""
+
+from hashlib import md5
+from mmap import mmap, ACCESS_READ
+import struct
+
+# File layout (all integers little-endian):
+#   header   -- _HEADER (magic, number of titles, salt, section offsets)
+#   keys     -- ntitles uint64 title hashes (see title_hash), sorted
+#   entryidx -- ntitles+1 uint32 offsets of each entry, relative to entries
+#   entries  -- for each title, in order of hash, its offsets as varints
+#               (delta-encoded)
+# Titles are not stored: the salt is chosen so that the hashes of the
+# titles in the index are distinct. (A title not in the index has a chance
+# of about ntitles/2**64 of having the hash of one that is.)
+_MAGIC = 'IMDBTIX1'
+_HEADER = struct.Struct('<8sIIQQQ')
+_KEY = struct.Struct('<Q')
+
+def title_hash(title, salt=0):
+    """Return the 64-bit key of title (a UTF-8 string)."""
+    return _KEY.unpack_from(md5(struct.pack('<I', salt) + title).digest())[0]
+
+def _encode_varint(value, out):
+    """Append the varint encoding of a non-negative integer to out."""
+    while value > 0x7f:
+        out.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    out.append(chr(value))
+
+def encode_offsets(offsets):
+    """Return the encoding of offsets, a list of non-negative integers in
+    ascending order."""
+    out = []
+    last = 0
+    for offset in offsets:
+        _encode_varint(offset - last, out)
+        last = offset
+    return ''.join(out)
+
+def decode_offsets(data):
+    """Return the list of offsets encoded in data (see encode_offsets)."""
+    offsets = []
+    offset = value = shift = 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:         # Last byte of a varint
+            offset += value
+            offsets.append(offset)
+            value = shift = 0
+        else:
+            shift += 7
+    return offsets
+
+class TitleIndex(object):
+    """Reader/writer for a file mapping titles to lists of offsets (such as
+    the positions of their lines in a data file), in which the offsets of a
+    title are found by binary search over fixed-width title hashes, without
+    parsing any text."""
+
+    def __init__(self, filename, mode='r'):
+        """Open the title index filename for reading (mode=r, mapping it
+        from the file) or create it (mode=w)."""
+        if mode not in ('r', 'w'):
+            raise ValueError('Mode must be r or w')
+        self.filename = filename
+        self.mode = mode
+        if mode == 'w':
+            self.fh = open(filename, 'wb')
+            self._entries = []
+            self.data = None
+        else:
+            self.fh = open(filename, 'rb')
+            self.data = mmap(self.fh.fileno(), 0, access=ACCESS_READ)
+            magic, self.ntitles, self.salt, self._keys_off, \
+                self._entryidx_off, self._entries_off = \
+                _HEADER.unpack_from(self.data, 0)
+            if magic != _MAGIC:
+                raise ValueError('%s is not a title index' % filename)
+
+    def add(self, title, offsets):
+        """Add title (a UTF-8 string, not already added) and its offsets, a
+        list of integers in ascending order, to the index."""
+        assert self.mode == 'w'
+        self._entries.append((title, encode_offsets(offsets)))
+
+    def close(self):
+        """Close the file. Must be called after writing to avoid data loss."""
+        if self.mode == 'w' and self.fh:
+            salt = 0
+            while True:
+                keys = sorted((title_hash(title, salt), i)
+                              for i, (title, _) in enumerate(self._entries))
+                if all(keys[i][0] != keys[i+1][0]
+                       for i in xrange(len(keys)-1)):
+                    break
+                salt += 1       # Two titles have the same hash
+            entries = [self._entries[i][1] for _, i in keys]
+            keys_off = _HEADER.size
+            entryidx_off = keys_off + len(keys)*_KEY.size
+            entries_off = entryidx_off + (len(keys)+1)*4
+            self.fh.write(_HEADER.pack(_MAGIC, len(keys), salt, keys_off,
+                                       entryidx_off, entries_off))
+            self.fh.write(''.join(_KEY.pack(key) for key, _ in keys))
+            pos = 0
+            for entry in entries:
+                self.fh.write(struct.pack('<I', pos))
+                pos += len(entry)
+            self.fh.write(struct.pack('<I', pos))
+            self.fh.write(''.join(entries))
+            self._entries = None
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+
+    def _key(self, i):
+        """Return the i-th (sorted) title hash."""
+        return _KEY.unpack_from(self.data, self._keys_off + i*8)[0]
+
+    def _offsets(self, i):
+        """Return the offsets of the i-th title."""
+        start, end = struct.unpack_from('<II', self.data,
+                                        self._entryidx_off + i*4)
+        return decode_offsets(self.data[self._entries_off+start:
+                                        self._entries_off+end])
+
+    def lookup(self, title):
+        """Return the offsets of title (a UTF-8 string), or an empty list if
+        it is not in the index."""
+        key = title_hash(title, self.salt)
+        unpack_from, data, keys_off = _KEY.unpack_from, self.data, \
+            self._keys_off
+        low, high = 0, self.ntitles
+        while low < high:
+            mid = (low+high) // 2
+            if unpack_from(data, keys_off + mid*8)[0] < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.ntitles and self._key(low) == key:
+            return self._offsets(low)
+        return []
@@ -1,13 +1,23 @@
 """utils - Shared utility functions."""
 
+from array import array
+from multiprocessing import Pool, cpu_count
 from subprocess import Popen, PIPE, STDOUT
+from threading import Lock
 from time import time, sleep
+import os
+import sys
 
 # Rate-limit configuration, to avoid using 100% CPU time for long searches.
 # Set RATELIMIT = (x,y) to have search_index sleep y seconds (default 0.1)
 # every x seconds (default 1/6.0). If RATELIMIT or x is false, never sleep.
 RATELIMIT = (1/6.0, 0.1)
 
+# Worker processes shared by searches and IMDb.populate, kept between calls
+# (and never terminated, since another thread may be using them)
+_POOL = None
+_POOL_LOCK = Lock()
+
 class TimerTimeout(Exception):
     """A Timer has exceeded its timeout."""
     pass
@@ -94,3 +104,59 @@ def open_compressed(filename=None, fileobj=None, mode='r',
     else:
         raise ValueError("Must specify read or write")
 
+
+def resident_memory():
+    """Return the resident set size of this process in bytes, or None if it
+    cannot be determined (currently only supported on Linux)."""
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def get_pool():
+    """Return the pool of worker processes (one per CPU) shared by this
+    process, creating it if needed. Threaded programs should call this
+    before starting their threads, since the workers are forked from the
+    calling thread."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = Pool(cpu_count())
+    return _POOL
+
+def wait_result(pending, timer):
+    """Return the result of pending (an AsyncResult of the shared pool),
+    raising TimerTimeout if timer expires first. The wait can be
+    interrupted (by KeyboardInterrupt), and leaves the tasks running on
+    timeout or interruption, since they must stop on their own."""
+    while not pending.ready():
+        pending.wait(0.1)
+        timer.check_expired()
+    return pending.get()
+
+# Array types of the 4-byte values stored in binary index files, by type:
+# signed and unsigned integers, and floats
+_ARRAY_TYPECODES = {'i': 'il', 'I': 'IL', 'f': 'f'}
+
+def load_array(typecode, data=''):
+    """Return an array of 4-byte values of typecode ('i' or 'I' for signed
+    or unsigned integers, or 'f' for floats) loaded from data, their
+    little-endian serialization."""
+    for arraycode in _ARRAY_TYPECODES[typecode]:
+        if array(arraycode).itemsize == 4:
+            arr = array(arraycode)
+            break
+    else:
+        raise RuntimeError('No 4-byte array type %s available' % typecode)
+    arr.fromstring(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+def dump_array(arr):
+    """Return the little-endian serialization of an array."""
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tostring()
@@ -1,17 +1,23 @@
 #!/usr/bin/env python
 """Test for regressions in the search engine."""
 
-from imdb import IMDb
+from imdb import IMDb, search
+from imdb.parsers import _find_seeks_sparse
+import os.path
+import shutil
 import sys
+from tempfile import mkdtemp
 
 errors = 0
 
 imdb = IMDb(dbfile='imdb.zip')
+queries = []
 for line in sys.stdin:
     line = line.decode('utf-8').strip()
     if not line or line[0] == '#':
         continue
     title, year, match = line.split('|')
+    queries.append((title, year))
     print '%s: ' % match,
     results = imdb.search(title, year=(int(year) if year else None))
     result = results[0][0].title if results else None
@@ -21,6 +27,34 @@ for line in sys.stdin:
         print 'NOT OK; got %s' % result
         errors += 1
 
+# A sparse index gives no section for a title before its first title (and
+# not the whole file)
+print 'Sparse index: ',
+sparse = (['b', 'd'], [0, 100])
+seeks = list(_find_seeks_sparse(sparse, [u'a', u'c']))
+if seeks == [(0, 100, 1)]:
+    print 'OK'
+else:
+    print 'NOT OK; got %s' % seeks
+    errors += 1
+
+# Sharding the n-gram index does not change the results
+print 'Shards: ',
+tempdir = mkdtemp()
+try:
+    results = []
+    for shards in (1, 3):
+        dbfile = os.path.join(tempdir, 'shards%d.zip' % shards)
+        search.write_ngrams(dbfile, shards=shards, idxfile='imdb.zip.idx')
+        results.append(search.search_many(dbfile, queries))
+finally:
+    shutil.rmtree(tempdir)
+if results[0] == results[1]:
+    print 'OK'
+else:
+    print 'NOT OK; results differ'
+    errors += 1
+
 print "Tests complete; %d errors." % errors
 if errors > 0:
     sys.exit(1)
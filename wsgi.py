@@ -10,7 +10,7 @@ from cgi import parse_qs
 import imdb
 import json
 from imdb.parsers import parse_name
-from imdb.utils import TimerTimeout
+from imdb.utils import TimerTimeout, get_pool
 
 SUPPORTED_ARGS = ('title', 'rating', 'plot', 'color_info', 'genres',
     'running_time', 'certificates', 'cast', 'directors', 'writers', 'aka')
@@ -18,7 +18,12 @@ SUPPORTED_ARGS = ('title', 'rating', 'plot', 'color_info', 'genres',
 imdbfile = 'imdb.zip'
 if 'IMDB' in os.environ:
     imdbfile = os.environ['IMDB']
-iface = imdb.IMDb(dbfile=imdbfile)
+# Set IMDB_IN_MEMORY=1 to keep the search index in memory between requests
+in_memory = os.environ.get('IMDB_IN_MEMORY', '') not in ('', '0')
+iface = imdb.IMDb(dbfile=imdbfile, in_memory=in_memory)
+# Start the worker processes of searches and populate now, before the server
+# starts any request threads, rather than forking them from a request
+get_pool()
 
 def run_search(query, year):
     # Timeout searches after several minutes. This allows excessively
@@ -38,6 +43,9 @@ def format_response(query, year):
     if not result:
         return {'_error': 'No results'}
     obj = {'_score': result[1]}
+    # Read the data files for all of the properties at the same time
+    iface.populate((result[0],), fields=[key for key in SUPPORTED_ARGS
+                                         if key not in ('title', 'aka')])
     for key in SUPPORTED_ARGS:
         out = getattr(result[0], key)
         # Convert names to "First Last"